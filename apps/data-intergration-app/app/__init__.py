@@ -6,6 +6,7 @@ from flask import Flask, request, abort
 from flask_migrate import Migrate
 from app.models import ProcessingConfig, ProcessingEntry  # noqa
 from app.producer import produce_sync_tasks
+from app.scheduler import SYNC_QUEUES
 from app.tasks import rq
 from app.helpers import ConfigVariableHelper, StackdriverLogFormatter
 from app.admin import admin
@@ -30,6 +31,8 @@ def create_app(testing=False):
         'POSTGRES_URL')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['RQ_REDIS_URL'] = config_helper.get_variable('REDIS_URL')
+    app.config['RQ_QUEUES'] = SYNC_QUEUES
+    app.config['RQ_WORKER_CLASS'] = 'app.scheduler.WeightedFairWorker'
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
     app.secret_key = config_helper.get_variable('FLASK_SECRET_KEY')
 
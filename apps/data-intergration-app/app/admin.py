@@ -11,6 +11,9 @@ from app.helpers import ConfigVariableHelper
 from app.dict_types import REQUIRED_FIELDS_MAPPING, OPTIONAL_FIELDS_MAPPING, DictType
 from google.api_core.exceptions import InvalidArgument
 from binascii import Error as Base64Error
+from liquid.exceptions import Error as LiquidError
+from app.liquid_templates import get_template
+from app.s3 import transfer_settings, S3TransferConfigException
 
 
 class LiquidException(Exception):
@@ -27,7 +30,8 @@ class ProcessingConfigAdminView(ModelView):
     column_filters = ['customer', 'import_type', 'parser_class']
     form_create_rules = (
         'file_url', 'connection_username', 'connection_password', 'connection_path', 'customer', 'import_type',
-        'parser_class', 'api_token_env_variable', 'check_subdirs', 'field_mapping', 's2s_token')
+        'parser_class', 'api_token_env_variable', 'check_subdirs', 'field_mapping', 's2s_token',
+        'download_concurrency', 's3_transfer_config')
     form_excluded_columns = (
         'processing_entries', 'connection_port'
     )
@@ -44,6 +48,10 @@ class ProcessingConfigAdminView(ModelView):
                 config.last_processing_started_at = None
                 config.last_processed_at = None
                 config.last_successfully_processed_at = None
+                config.last_seen_modified_at = None
+                config.http_validators = None
+                config.next_sync_at = None
+                config.poll_interval_seconds = None
             db.session.commit()
 
             flash('Entries successfully reset')
@@ -57,6 +65,11 @@ class ProcessingConfigAdminView(ModelView):
                 raise LiquidException(f'Invalid key: "{key}". Mapping needs to have two keys: column_name and template')
             if not isinstance(value, str):
                 raise LiquidException('Liquid template must be a string. See docs: https://jg-rp.github.io/liquid/')
+            if key == 'template':
+                try:
+                    get_template(value)
+                except LiquidError as e:
+                    raise LiquidException(f'Invalid Liquid template "{value}": {e}')
 
     def validate_field_mapping(self, field_mappings, dict_type):
         if field_mappings in [None, {}]:
@@ -98,11 +111,15 @@ class ProcessingConfigAdminView(ModelView):
                     self.validate_field_mapping(form.field_mapping.data, DictType.FIELD_MAPPING_S2S)
                 if form.import_type.data == 'aggregate_multiplatform_s2s':
                     self.validate_field_mapping(form.field_mapping.data, DictType.FIELD_MAPPING_S2S)
+            if hasattr(form, 's3_transfer_config') and form.s3_transfer_config.data not in [None, {}]:
+                transfer_settings(form.s3_transfer_config.data)
             return super().validate_form(form)
         except LiquidException as e:
             flash(f'LiquidException: {e}')
         except FieldMappingException as e:
             flash(f'FieldMappingException: {e}')
+        except S3TransferConfigException as e:
+            flash(f'S3TransferConfigException: {e}')
 
     def on_model_change(self, form, model, is_created):
         # If S2S token exists and it's not encrypted, encrypt it with Google KMS.
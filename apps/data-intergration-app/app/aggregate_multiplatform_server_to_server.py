@@ -14,6 +14,9 @@ class AggregateMultiplatformServerToServerSender:
     API_URL = '[FILL ME IN S2S ENDPOINT]'
     REQUIRED_FIELDS = ['platform', 'ad_unit_id', 'event_name', 'ad_interaction_time']
     OPTIONAL_FIELDS = ['event_time', 'install_time', 'conversions', 'value', 'value_currency']
+    # A request is sent once either limit would be exceeded by the next event
+    MAX_BATCH_EVENTS = 1000
+    MAX_BATCH_BYTES = 1024 * 1024
 
     def __init__(self, data, api_token_env_variable, s2s_token=None):
         self.events = data
@@ -32,22 +35,58 @@ class AggregateMultiplatformServerToServerSender:
 
         successes = 0
         failures = 0
-        for row in self.events:
-            self.to_aggregate_multiplatform_s2s_event(row)
-            response = session.post(self.API_URL, data=json.dumps({'events': [(row)]}), headers=headers)
-            if response.ok:
-                successes += 1
-            else:
-                failures += 1
-                error_message = response.json().get('message')
-                current_app.logger.error(
-                        f'Failed to send S2S event! Status: {response.status_code} Msg: {error_message} '
-                        f'Id:{row.get("ad_unit_id")} Date:{row.get("ad_interaction_time")}')
+        for batch in self.batches(self.events):
+            batch_failures = self.send_batch(session, headers, batch)
+            successes += len(batch) - batch_failures
+            failures += batch_failures
 
         current_app.logger.info(
-            f'{successes}/{len(self.events)} S2S events sent successfully')
+            f'{successes}/{successes + failures} S2S events sent successfully')
         return {'successes': successes, 'failures': failures}
 
+    def batches(self, rows):
+        """
+        Yields lists of (row, serialized_row) tuples holding at most MAX_BATCH_EVENTS events and
+        MAX_BATCH_BYTES of serialized events. Rows are serialized once and reused for the payload.
+        """
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            self.to_aggregate_multiplatform_s2s_event(row)
+            serialized_row = json.dumps(row)
+            # +1 for the comma separating events in the payload
+            row_bytes = len(serialized_row.encode()) + 1
+            if batch and (len(batch) >= self.MAX_BATCH_EVENTS or batch_bytes + row_bytes > self.MAX_BATCH_BYTES):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append((row, serialized_row))
+            batch_bytes += row_bytes
+        if batch:
+            yield batch
+
+    def send_batch(self, session, headers, batch):
+        """
+        Posts a batch of events and returns the number of events that failed. The endpoint accepts
+        or rejects a batch as a whole, so a rejected batch is split in half and each half is sent
+        again until the rejected events are sent on their own. Only those count as failures.
+        """
+        payload = '{"events": [' + ','.join(serialized_row for _, serialized_row in batch) + ']}'
+        response = session.post(self.API_URL, data=payload, headers=headers)
+        if response.ok:
+            return 0
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            return self.send_batch(session, headers, batch[:middle]) + \
+                self.send_batch(session, headers, batch[middle:])
+
+        error_message = response.json().get('message')
+        row = batch[0][0]
+        current_app.logger.error(
+                f'Failed to send S2S event! Status: {response.status_code} Msg: {error_message} '
+                f'Id:{row.get("ad_unit_id")} Date:{row.get("ad_interaction_time")}')
+        return 1
+
     def to_aggregate_multiplatform_s2s_event(self, row):
         for field in self.REQUIRED_FIELDS:
             if row.get(field) is None:
@@ -0,0 +1,173 @@
+import bz2
+import shutil
+import tempfile
+import zipfile
+import zlib
+from contextlib import contextmanager
+import zstandard
+from app.helpers import DOWNLOAD_CHUNK_SIZE, SPOOL_MAX_SIZE
+
+MAGIC_NUMBERS = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'zip': b'PK\x03\x04',
+}
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.zst': 'zstd',
+    '.zip': 'zip',
+}
+MAGIC_NUMBER_SIZE = max(len(magic) for magic in MAGIC_NUMBERS.values())
+
+
+class DecompressionException(OSError):
+    pass
+
+
+def compression_of(filename):
+    for extension, compression in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    return None
+
+
+def new_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise DecompressionException(f'No stream decompressor for {compression}')
+
+
+class StreamDecompressor:
+    """
+    Write-only file-like object that decompresses written data into target as it arrives, so the
+    compressed file is never held anywhere. Concatenated streams (e.g. multi-member gzip) are supported.
+    """
+
+    def __init__(self, target, compression):
+        self.target = target
+        self.compression = compression
+        self._decompressor = new_decompressor(compression)
+        self._fed = False
+        self._finished_streams = 0
+
+    def write(self, data):
+        size = len(data)
+        try:
+            while data:
+                if not self._fed and self._finished_streams:
+                    # Like the gzip module, zero padding after the last stream is ignored
+                    data = data.lstrip(b'\x00')
+                    if not data:
+                        break
+                self._fed = True
+                self.target.write(self._decompressor.decompress(data))
+                if not getattr(self._decompressor, 'eof', False):
+                    break
+                data = self._decompressor.unused_data
+                self._decompressor = new_decompressor(self.compression)
+                self._fed = False
+                self._finished_streams += 1
+        except (zlib.error, OSError, EOFError, ValueError, zstandard.ZstdError) as e:
+            raise DecompressionException(f'Invalid {self.compression} data: {e}')
+        return size
+
+    def close(self):
+        if self._fed and not getattr(self._decompressor, 'eof', True):
+            raise DecompressionException(f'Truncated {self.compression} data')
+
+
+class ZipDecompressor:
+    """
+    The central directory of a zip file is at its end, so the archive is spooled to a temporary file
+    and its CSV member is streamed into target once the download is complete.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def close(self):
+        try:
+            with zipfile.ZipFile(self.file) as archive:
+                members = [member for member in archive.infolist() if not member.is_dir()]
+                if not members:
+                    raise DecompressionException('Empty zip archive')
+                csv_members = [member for member in members if member.filename.endswith('.csv')]
+                with archive.open((csv_members or members)[0]) as member:
+                    shutil.copyfileobj(member, self.target, DOWNLOAD_CHUNK_SIZE)
+        except zipfile.BadZipFile as e:
+            raise DecompressionException(f'Invalid zip data: {e}')
+        finally:
+            self.file.close()
+
+
+class SniffingDecompressor:
+    """
+    Picks the decompressor once the first bytes are known: data without the magic number of the
+    expected compression is passed through to target as is.
+    """
+
+    def __init__(self, target, compression):
+        self.target = target
+        self.compression = compression
+        self._head = b''
+        self._writer = None
+
+    def write(self, data):
+        if self._writer is None:
+            self._head += data
+            if len(self._head) < MAGIC_NUMBER_SIZE:
+                return len(data)
+            self._start()
+        else:
+            self._writer.write(data)
+        return len(data)
+
+    def _start(self):
+        if self._head.startswith(MAGIC_NUMBERS[self.compression]):
+            self._writer = open_decompressor(self.target, self.compression)
+        else:
+            self._writer = self.target
+        head, self._head = self._head, b''
+        self._writer.write(head)
+
+    def close(self):
+        if self._writer is None:
+            self._start()
+        if self._writer is not self.target:
+            self._writer.close()
+
+
+def open_decompressor(target, compression):
+    if compression == 'zip':
+        return ZipDecompressor(target)
+    return StreamDecompressor(target, compression)
+
+
+@contextmanager
+def decompressing_writer(filename, target, passthrough_uncompressed=False):
+    """
+    Yields a write-only file-like object to download filename into. Depending on the extension of
+    filename the data is decompressed on the way into target. With passthrough_uncompressed, files
+    that turn out not to be compressed are written into target unchanged instead of failing.
+    """
+    compression = compression_of(filename)
+    if compression is None:
+        yield target
+        return
+
+    if passthrough_uncompressed:
+        writer = SniffingDecompressor(target, compression)
+    else:
+        writer = open_decompressor(target, compression)
+    yield writer
+    writer.close()
@@ -1,9 +1,10 @@
 import requests
 import os
-import math
+from itertools import chain
+from urllib3.util.retry import Retry
 from flask import current_app
 import simplejson as json
-from app.helpers import ConfigVariableHelper
+from app.helpers import ConfigVariableHelper, ordered_map
 
 
 class CustomConversionSenderException(Exception):
@@ -12,35 +13,38 @@ class CustomConversionSenderException(Exception):
 
 class CustomConversionSender:
     API_URL = '[FILL ME IN S2S ENDPOINT]'
+    # A payload is closed once either limit would be exceeded by the next row
+    MAX_ROWS_PER_PAYLOAD = 10000
+    MAX_PAYLOAD_BYTES = 5 * 1024 * 1024
+    # Number of payloads uploaded at the same time
+    CONCURRENCY = 4
 
-    def __init__(self, data, api_token_env_variable):
+    def __init__(self, data, api_token_env_variable, concurrency=None):
         self.data = data
         self.api_token_env_variable = api_token_env_variable
-
-    @staticmethod
-    def chunks(data, chunk_size):
-        for i in range(0, chunk_size):
-            yield data[i::chunk_size]
-
-    def get_chunk_size(self):
-        if len(self.data) <= 10000:
-            return 1
-        else:
-            return math.ceil(len(self.data) / 10000)
+        self.concurrency = concurrency or self.CONCURRENCY
 
     def _generate_api_payloads(self):
-        payloads = []
-
-        for chunk in self.chunks(self.data, self.get_chunk_size()):
-            payload = {
-                'ignore_invalid_ad_ids': True,
-                'data': []
-            }
-            for row in chunk:
-                payload['data'].append(row)
-            payloads.append(payload)
-
-        return payloads
+        """
+        Lazily yields (row_count, body) tuples of serialized payloads holding contiguous rows, at most
+        MAX_ROWS_PER_PAYLOAD rows and roughly MAX_PAYLOAD_BYTES each.
+        """
+        prefix = '{"ignore_invalid_ad_ids": true, "data": ['
+        suffix = ']}'
+        rows = []
+        payload_bytes = len(prefix) + len(suffix)
+        for row in self.data:
+            serialized_row = json.dumps(row)
+            # +1 for the comma separating rows
+            row_bytes = len(serialized_row.encode()) + 1
+            if rows and (len(rows) >= self.MAX_ROWS_PER_PAYLOAD or payload_bytes + row_bytes > self.MAX_PAYLOAD_BYTES):
+                yield len(rows), prefix + ','.join(rows) + suffix
+                rows = []
+                payload_bytes = len(prefix) + len(suffix)
+            rows.append(serialized_row)
+            payload_bytes += row_bytes
+        if rows:
+            yield len(rows), prefix + ','.join(rows) + suffix
 
     def _get_api_token(self):
         config_helper = ConfigVariableHelper(
@@ -53,41 +57,59 @@ class CustomConversionSender:
         else:
             raise CustomConversionSenderException('Missing API token from ENV')
 
-    @staticmethod
-    def _rows_in_payload(payload):
-        return len(payload['data'])
+    def retrying_http_session(self):
+        # Only retry responses that guarantee the payload was not imported
+        session = requests.Session()
+        retries = Retry(
+            total=3, backoff_factor=1, allowed_methods=["POST"], status_forcelist=[429, 503], raise_on_status=False)
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            max_retries=retries, pool_connections=1, pool_maxsize=self.concurrency))
+        return session
+
+    def _send_payload(self, session, headers, payload):
+        # A failed payload counts as failures without stopping the other payloads, which may already be imported
+        row_count, body = payload
+        try:
+            response = session.post(self.API_URL, data=body, headers=headers)
+        except requests.RequestException as e:
+            current_app.logger.error(f'Failed to send custom conversion payload of {row_count} rows! Error: {e}')
+            return {'successes': 0, 'failures': row_count}
+        if not response.ok:
+            current_app.logger.error(
+                f'Failed to send custom conversion payload of {row_count} rows! Status: {response.status_code}')
+            return {'successes': 0, 'failures': row_count}
+        accepted = response.json().get('count')
+        return {
+            'successes': accepted,
+            'failures': row_count - accepted
+        }
 
     def send(self):
-        if len(self.data) > 0:
-            current_app.logger.info(
-                'Sending conversion events to custom conversion import API')
-            payloads = self._generate_api_payloads()
-            api_token = self._get_api_token()
-
-            headers = {
-                'Authorization': api_token,
-                'Content-Type': 'application/json'
-            }
-
-            responses = []
-            for payload in payloads:
-                response = requests.post(
-                    self.API_URL,
-                    data=json.dumps(payload),
-                    headers=headers)
-                response.raise_for_status()
-                response_data = response.json()
-                responses.append({
-                    'successes': response_data.get('count'),
-                    'failures': self._rows_in_payload(payload) - response_data.get('count')
-                })
-            total_successes = sum([r['successes'] for r in responses])
-            total_failures = sum([r['failures'] for r in responses])
-
-            return {
-                'successes': total_successes,
-                'failures': total_failures
-            }
-        else:
+        payloads = self._generate_api_payloads()
+        first_payload = next(payloads, None)
+        if first_payload is None:
             current_app.logger.info('No data to send to custom conversion import API')
             return {'successes': 0, 'failures': 0}
+
+        current_app.logger.info(
+            'Sending conversion events to custom conversion import API')
+        api_token = self._get_api_token()
+        headers = {
+            'Authorization': api_token,
+            'Content-Type': 'application/json'
+        }
+        session = self.retrying_http_session()
+
+        total_successes = 0
+        total_failures = 0
+        for result in ordered_map(
+                lambda payload: self._send_payload(session, headers, payload),
+                chain([first_payload], payloads),
+                self.concurrency):
+            total_successes += result['successes']
+            total_failures += result['failures']
+
+        return {
+            'successes': total_successes,
+            'failures': total_failures
+        }
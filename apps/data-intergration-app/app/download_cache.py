@@ -0,0 +1,121 @@
+import hashlib
+import os
+import tempfile
+from flask import current_app
+from app.helpers import DOWNLOAD_CHUNK_SIZE
+
+# Downloads are cached when this is set
+DOWNLOAD_CACHE_DIR = 'DOWNLOAD_CACHE_DIR'
+DOWNLOAD_CACHE_MAX_SIZE = 'DOWNLOAD_CACHE_MAX_SIZE'
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+
+def download_cache():
+    """The DownloadCache in DOWNLOAD_CACHE_DIR, or None when downloads are not cached."""
+    cache_dir = os.getenv(DOWNLOAD_CACHE_DIR)
+    if not cache_dir:
+        return None
+    return DownloadCache(cache_dir, int(os.getenv(DOWNLOAD_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_SIZE)))
+
+
+def cached_download(source, fingerprint, download, target):
+    """
+    Writes the raw bytes of the remote file source into target: from the cache when the version
+    identified by fingerprint is cached, else with download(writer) while a copy goes to the cache.
+    """
+    cache = download_cache() if source and fingerprint else None
+    if cache is None:
+        download(target)
+    elif not cache.read(source, fingerprint, target):
+        cache.write(source, fingerprint, download, target)
+
+
+class CachingWriter:
+    def __init__(self, target, cache_file):
+        self.target = target
+        self.cache_file = cache_file
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.cache_file.write(data)
+        return self.target.write(data)
+
+
+class DownloadCache:
+    """
+    Disk-backed, content-addressed cache of downloaded files. Blobs are stored under the SHA-256 of
+    their content, so identical files are stored once, and keys (source and fingerprint, e.g. path,
+    size and mtime or ETag) point to them. Reading a blob marks it as recently used, the least
+    recently used blobs are evicted once the blobs take more than max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.key_dir = os.path.join(cache_dir, 'keys')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.key_dir, exist_ok=True)
+
+    def _key_path(self, source, fingerprint):
+        key = hashlib.sha256(f'{source}\0{fingerprint}'.encode()).hexdigest()
+        return os.path.join(self.key_dir, key)
+
+    def read(self, source, fingerprint, target):
+        """Writes the cached file into target and returns True, or returns False on a cache miss."""
+        key_path = self._key_path(source, fingerprint)
+        try:
+            with open(key_path) as key_file:
+                blob_path = os.path.join(self.blob_dir, key_file.read().strip())
+            with open(blob_path, 'rb') as blob:
+                os.utime(blob_path)
+                for chunk in iter(lambda: blob.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    target.write(chunk)
+        except FileNotFoundError:
+            return False
+        current_app.logger.info(f'Read {source} from the download cache')
+        return True
+
+    def write(self, source, fingerprint, download, target):
+        """Runs download(writer) into target, storing the bytes in the cache once the download completes."""
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.blob_dir, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as cache_file:
+                writer = CachingWriter(target, cache_file)
+                download(writer)
+            os.replace(temporary_path, os.path.join(self.blob_dir, writer.digest.hexdigest()))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.key_dir, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as key_file:
+            key_file.write(writer.digest.hexdigest())
+        os.replace(temporary_path, self._key_path(source, fingerprint))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used blobs beyond max_size and the keys pointing to removed blobs."""
+        blobs = []
+        for entry in os.scandir(self.blob_dir):
+            if not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        for entry in os.scandir(self.key_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                with open(entry.path) as key_file:
+                    blob_path = os.path.join(self.blob_dir, key_file.read().strip())
+                if not os.path.exists(blob_path):
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
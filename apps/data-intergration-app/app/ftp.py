@@ -1,53 +1,286 @@
+import paramiko
 import pysftp
-import io
 import os
+import re
+import stat
+import threading
 import calendar
-import gzip
-from app.helpers import get_csv_reader, bytesio_md5, detect_encoding
+from app.compression import decompressing_writer, DecompressionException, EXTENSIONS
+from app.helpers import HashingSpool, get_reader_from_spool, file_fingerprint, ordered_map
+from app.helpers import DOWNLOAD_CHUNK_SIZE
+from app.resumable import partial_download
+from app.download_cache import cached_download
+from collections import namedtuple
 from flask import current_app
-from ftplib import FTP
+from ftplib import FTP, error_perm, error_reply
 from dateutil import parser
-from datetime import datetime
+from datetime import datetime, timedelta
 
+# local_time is set for timestamps in the unknown time zone of the server (LIST), they are UTC otherwise
+FTPFile = namedtuple('FTPFile', ['name', 'size', 'timestamp', 'local_time'], defaults=[False])
+# Largest difference between the local time of a server and UTC
+MAX_UTC_OFFSET = 14 * 60 * 60
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+# e.g. "-rw-r--r--   1 owner group   1234 Jan 31 10:15 name" or "... 1234 Jan 31  2020 name"
+UNIX_LIST_LINE = re.compile(
+    r'^(?P<type>[-dlbcps])\S{9}\S*\s+\d+\s+\S+\s+\S+\s+(?P<size>\d+)\s+'
+    r'(?P<month>[A-Za-z]{3})\s+(?P<day>\d{1,2})\s+(?P<time>\d{1,2}:\d{2}|\d{4})\s(?P<name>.+)$')
+# e.g. "01-31-20  10:15AM       1234 name" or "01-31-20  10:15AM  <DIR>  name"
+DOS_LIST_LINE = re.compile(
+    r'^(?P<date>\d{2}-\d{2}-\d{2}(?:\d{2})?)\s+(?P<time>\d{1,2}:\d{2}[AP]M)\s+(?P<size><DIR>|\d+)\s+(?P<name>.+)$')
 
-def get_reader_from_bytes(bts, filename):
-    data = bts.getvalue()
-    if len(data) > 0:
-        encoding = detect_encoding(data)
-        md5 = bytesio_md5(data)
-        csv_data = data.decode(encoding).splitlines()
-        return (get_csv_reader(csv_data), md5, filename)
+
+class FTPListingException(Exception):
+    pass
+
+
+def read_sftp_file(connection, remote_path, offset, write):
+    with connection.open(remote_path, 'rb') as remote_file:
+        remote_file.seek(offset)
+        remote_file.prefetch()
+        for chunk in iter(lambda: remote_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            write(chunk)
+
+
+def download_sftp_file(channels, remote_path, writer, source=None, fingerprint=None, size=None):
+    partial = partial_download(source, fingerprint, size) if source else None
+    if partial:
+        with partial:
+            # Retries resume over a new channel, the one that failed may be dead
+            partial.fetch(
+                lambda offset, write: read_sftp_file(channels.get(), remote_path, offset, write), channels.discard)
+            partial.replay(writer)
     else:
-        current_app.logger.info('Empty file: {}'.format(filename))
-        return None
+        channels.get().getfo(remote_path, writer)
 
 
-def get_reader_from_sftp(connection, file_name):
-    current_app.logger.info('Starting fo fetch file {}'.format(file_name))
-    bts = io.BytesIO()
-    connection.getfo(file_name, bts)
-    if file_name.endswith('.gz'):
-        try:
-            bts = io.BytesIO(gzip.decompress(bts.getvalue()))
-        except OSError:
-            current_app.logger.info(f'Attempted decompressing invalid gzip: {file_name}')
+def get_reader_from_sftp(
+        channels, file_name, fingerprint=None, encoding_hint=None, remote_path=None, source=None, size=None):
+    remote_path = remote_path or file_name
+    current_app.logger.info('Starting fo fetch file {}'.format(remote_path))
+    spool = HashingSpool(encoding_hint)
+    try:
+        # Files that are named as compressed but are not are read as plain CSV
+        with decompressing_writer(file_name, spool, passthrough_uncompressed=True) as writer:
+            cached_download(source, fingerprint, lambda raw_writer: download_sftp_file(
+                channels, remote_path, raw_writer, source, fingerprint, size), writer)
+    except DecompressionException as error:
+        current_app.logger.info(f'Attempted decompressing invalid file: {file_name}')
+        raise error
     current_app.logger.info('Got file {}'.format(file_name))
-    return get_reader_from_bytes(bts, file_name)
+    return get_reader_from_spool(spool, file_name, fingerprint)
+
+
+class ThreadLocalPool:
+    """
+    Lazily opens one connection per worker thread with open_connection and keeps track of them so
+    they can be closed once all downloads are done. Files are parsed and sent between downloads, so
+    a connection may sit idle long enough for the server to drop it. A connection that is_alive
+    reports as dropped is replaced before it is handed out again.
+    """
+
+    def __init__(self, open_connection, close_connection, is_alive=None):
+        self.open_connection = open_connection
+        self.close_connection = close_connection
+        self.is_alive = is_alive
+        self.connections = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self.is_alive and not self.is_alive(connection):
+            current_app.logger.info('Pooled connection was dropped, opening a new one')
+            self.discard()
+            connection = None
+        if connection is None:
+            connection = self.open_connection()
+            self._local.connection = connection
+            with self._lock:
+                self.connections.append(connection)
+        return connection
+
+    def discard(self):
+        """Closes the connection of the calling thread, its next get() opens a new one."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        with self._lock:
+            self.connections.remove(connection)
+        self._close(connection)
+
+    def _close(self, connection):
+        try:
+            self.close_connection(connection)
+        except Exception as e:
+            current_app.logger.info(f'Failed to close pooled connection: {e}')
+
+    def close(self):
+        """Closes all connections, the next get() of any thread opens a new one."""
+        for connection in self.connections:
+            self._close(connection)
+        self.connections = []
+        self._local = threading.local()
+
+
+def sftp_channel_pool(sftp, connect):
+    """
+    SFTP channels multiplexed over the SSH transport of an open pysftp connection. Once that transport
+    has dropped, channels are opened over new connections from connect().
+    """
+    cwd = sftp.pwd
+
+    def open_channel():
+        if not sftp._transport.is_active():
+            connection = connect()
+            connection.cwd(cwd)
+            return connection
+        channel = paramiko.SFTPClient.from_transport(sftp._transport)
+        channel.get_channel().settimeout(sftp.timeout)
+        channel.chdir(cwd)
+        return channel
+
+    return ThreadLocalPool(open_channel, lambda channel: channel.close(), sftp_channel_alive)
+
+
+def sftp_channel_alive(channel):
+    # Channels opened over a new connection are pysftp connections wrapping the SFTP client
+    channel = getattr(channel, 'sftp_client', channel).get_channel()
+    return not channel.closed and channel.get_transport().is_active()
+
+
+def ftp_connection_alive(connection):
+    try:
+        connection.voidcmd('NOOP')
+    except Exception:
+        return False
+    return True
 
 
-def file_should_be_downloaded(filename, timestamp, last_successful_sync):
+def close_ftp(connection):
+    try:
+        connection.quit()
+    finally:
+        connection.close()
+
+
+def ftp_connection_pool(host, port, username, password, path):
+    def open_connection():
+        return connect_ftp(host, port, username, password, path)
+
+    return ThreadLocalPool(open_connection, close_ftp, ftp_connection_alive)
+
+
+def file_should_be_downloaded(filename, timestamp, last_successful_sync, fingerprint=None, known_fingerprints=()):
     current_app.logger.info(
                 '{}, mtime={}, last_successful_sync={}'.format(filename, timestamp, last_successful_sync))
     last_success_timestamp = calendar.timegm(last_successful_sync.utctimetuple()) if last_successful_sync else None
-    filename_allowed = filename.endswith('.csv') or filename.endswith('.csv.gz')
+    filename_allowed = filename.endswith('.csv') or any(
+        filename.endswith('.csv' + extension) for extension in EXTENSIONS)
     file_uploaded_after_last_success = last_success_timestamp is None or timestamp > last_success_timestamp
+    file_already_fetched = fingerprint is not None and fingerprint in known_fingerprints
     if not filename_allowed:
         current_app.logger.info(f'Skipping download of file #{filename}: File type not allowed.')
     elif not file_uploaded_after_last_success:
         current_app.logger.info(
             f'Skipping download of file #{filename}: Already processed successfully.'
         )
-    return filename_allowed and file_uploaded_after_last_success
+    elif file_already_fetched:
+        current_app.logger.info(
+            f'Skipping download of file #{filename}: Fingerprint {fingerprint} already processed.'
+        )
+    return filename_allowed and file_uploaded_after_last_success and not file_already_fetched
+
+
+def is_sftp_dir(attr):
+    return attr.st_mode is not None and stat.S_ISDIR(attr.st_mode)
+
+
+def is_sftp_link(attr):
+    return attr.st_mode is not None and stat.S_ISLNK(attr.st_mode)
+
+
+def follow_sftp_link(channel, entry_path, attr):
+    """SFTPAttributes of the target of the link at entry_path under the name of the link, or None if it is broken."""
+    try:
+        target = channel.stat(entry_path)
+    except IOError as e:
+        current_app.logger.info(f'Skipping broken link {entry_path}: {e}')
+        return None
+    target.filename = attr.filename
+    return target
+
+
+def list_sftp_files(channels, check_subdir=False, max_workers=1):
+    """
+    Lists the files under the working directory of the channels, and under its subdirectories when
+    check_subdir is set, as (relative path, SFTPAttributes) pairs. Directories are told apart by the
+    st_mode that listdir_attr already returns, so there is no round-trip per entry. listdir_attr does
+    not follow links, only links are stat'ed to tell linked directories from linked files. The tree is listed
+    level by level, with the directories of a level listed concurrently when max_workers > 1. Files
+    are returned depth first, a directory's files before the files of its subdirectories.
+    """
+    listings = {}
+    # Real paths of the directories walked through links, so link cycles are not walked forever
+    linked_dirs = {channels.get().normalize('.')}
+    level = ['.']
+    while level:
+        next_level = []
+        attr_lists = ordered_map(lambda directory: channels.get().listdir_attr(directory), level, max_workers)
+        for directory, attrs in zip(level, attr_lists):
+            files = []
+            subdirs = []
+            for attr in attrs:
+                entry_path = attr.filename if directory == '.' else os.path.join(directory, attr.filename)
+                if is_sftp_link(attr):
+                    attr = follow_sftp_link(channels.get(), entry_path, attr)
+                    if attr is None:
+                        continue
+                    if is_sftp_dir(attr) and check_subdir:
+                        real_path = channels.get().normalize(entry_path)
+                        if real_path in linked_dirs:
+                            continue
+                        linked_dirs.add(real_path)
+                if not is_sftp_dir(attr):
+                    files.append((entry_path, attr))
+                elif check_subdir:
+                    subdirs.append(entry_path)
+            listings[directory] = (files, subdirs)
+            next_level += subdirs
+        level = next_level
+
+    def walk(directory):
+        files, subdirs = listings[directory]
+        yield from files
+        for subdir in subdirs:
+            yield from walk(subdir)
+
+    return list(walk('.'))
+
+
+def connect_sftp(host, port, user, password):
+    cnopts = pysftp.CnOpts()
+    cnopts.hostkeys = None
+    cinfo = {'host': host, 'port': port, 'username': user,
+             'password': password, 'cnopts': cnopts}
+    sftp = pysftp.Connection(**cinfo)
+    sftp.timeout = 300.0  # Needs to be float. 300s is 50% of 600s set for task
+    return sftp
+
+
+def new_sftp_files(channels, path, last_successful_sync, check_subdir=False, known_fingerprints=(), max_workers=1):
+    """
+    (relative path, SFTPAttributes, fingerprint) of the files in the working directory of the channels
+    to download.
+    """
+    new_files = []
+    for file_path, attr in list_sftp_files(channels, check_subdir, max_workers):
+        fingerprint = file_fingerprint('sftp', os.path.join(path or '', file_path), attr.st_size, attr.st_mtime)
+        if file_should_be_downloaded(
+                attr.filename, attr.st_mtime, last_successful_sync, fingerprint, known_fingerprints):
+            new_files.append((file_path, attr, fingerprint))
+    return new_files
 
 
 def get_files_in_sftp_url(
@@ -57,53 +290,220 @@ def get_files_in_sftp_url(
         path=".",
         port=22,
         last_successful_sync=None,
-        check_subdir=False):
+        check_subdir=False,
+        known_fingerprints=(),
+        max_workers=1,
+        encoding_hint=None):
     current_app.logger.info('Getting files from {}, path: {}'.format(host, path))
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
     port = port if port is not None else 22
-    cinfo = {'host': host, 'port': port, 'username': user,
-             'password': password, 'cnopts': cnopts}
-    with pysftp.Connection(**cinfo) as sftp:
-        sftp.timeout = 300.0  # Needs to be float. 300s is 50% of 600s set for task
+    with connect_sftp(host, port, user, password) as sftp:
         if path is not None:
             sftp.cwd(path)
-        files = sftp.listdir_attr('.')
-        csv_readers = []
-        for attr in files:
-            if check_subdir and sftp.isdir(attr.filename):
-                new_path = os.path.join(path, attr.filename) if path else attr.filename
-                csv_readers += get_files_in_sftp_url(
-                    host, user, password, new_path, port, last_successful_sync, check_subdir)
-            elif file_should_be_downloaded(attr.filename, attr.st_mtime, last_successful_sync):
-                csv_readers.append(get_reader_from_sftp(sftp, attr.filename))
-        sftp.close()
-    return list(filter(None, csv_readers))
-
-
-def get_reader_from_ftp(connection, filename):
-    current_app.logger.info('Starting fo fetch file {}'.format(filename))
-    bts = io.BytesIO()
-    connection.retrbinary('RETR ' + filename, bts.write)
-    current_app.logger.info('Got file {}'.format(filename))
-    return get_reader_from_bytes(bts, filename)
+        # Listing and downloads share the one SSH transport, each worker thread gets a channel of its own
+        channels = sftp_channel_pool(sftp, lambda: connect_sftp(host, port, user, password))
+        try:
+            downloads = [
+                (attr.filename, fingerprint, encoding_hint, file_path,
+                 'sftp://{}:{}/{}'.format(host, port, os.path.join(path or '', file_path)), attr.st_size)
+                for file_path, attr, fingerprint in new_sftp_files(
+                    channels, path, last_successful_sync, check_subdir, known_fingerprints, max_workers)
+            ]
 
+            # The channels of the listing threads would stay open next to those of the download threads,
+            # servers limit the sessions per connection (OpenSSH MaxSessions defaults to 10)
+            channels.close()
+            for fetched_file in ordered_map(
+                    lambda download: get_reader_from_sftp(channels, *download), downloads, max_workers):
+                if fetched_file:
+                    yield fetched_file
+        finally:
+            channels.close()
 
-def get_files_in_ftp_url(host, username=None, password=None, path='.', port=21, last_successful_sync=None):
-    current_app.logger.info('Getting files from {}, path: {}'.format(host, path))
-    port = port if port is not None else 21
+
+def connect_ftp(host, port, username, password, path):
     connection = FTP()
     connection.connect(host=host, port=port, timeout=300)
     connection.login(user=username, passwd=password)
     connection.cwd(path)
-    files = connection.nlst()
-    csv_readers = []
-    for file in files:
+    return connection
+
+
+def download_ftp_file(connections, filename, writer, source=None, fingerprint=None, size=None):
+    partial = partial_download(source, fingerprint, size) if source else None
+    if partial:
+        with partial:
+            # REST makes the server send the file from offset on. After an aborted RETR the control
+            # connection is out of sync, so retries resume over a new connection.
+            partial.fetch(lambda offset, write: connections.get().retrbinary(
+                'RETR ' + filename, write, blocksize=DOWNLOAD_CHUNK_SIZE, rest=offset or None), connections.discard)
+            partial.replay(writer)
+    else:
+        connections.get().retrbinary('RETR ' + filename, writer.write, blocksize=DOWNLOAD_CHUNK_SIZE)
+
+
+def get_reader_from_ftp(connections, filename, fingerprint=None, encoding_hint=None, source=None, size=None):
+    current_app.logger.info('Starting fo fetch file {}'.format(filename))
+    spool = HashingSpool(encoding_hint)
+    try:
+        with decompressing_writer(filename, spool, passthrough_uncompressed=True) as writer:
+            cached_download(source, fingerprint, lambda raw_writer: download_ftp_file(
+                connections, filename, raw_writer, source, fingerprint, size), writer)
+    except DecompressionException as error:
+        current_app.logger.info(f'Attempted decompressing invalid file: {filename}')
+        raise error
+    current_app.logger.info('Got file {}'.format(filename))
+    return get_reader_from_spool(spool, filename, fingerprint)
+
+
+def mlsd_files(connection):
+    files = []
+    for name, facts in connection.mlsd():
+        if facts['type'] != 'file':
+            continue
+        # MLSD times are UTC, YYYYMMDDHHMMSS optionally followed by fractions of a second
+        modified_time = datetime.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')
+        size = int(facts['size']) if 'size' in facts else None
+        files.append(FTPFile(name, size, calendar.timegm(modified_time.utctimetuple())))
+    return files
+
+
+def parse_list_line(line, now):
+    """
+    Parses a line of a Unix or DOS style LIST response into an FTPFile, or None for entries that are
+    not files. LIST times have a precision of a minute (or a day for older Unix entries), they are
+    rounded up to the end of that period so files are never taken for older than they are.
+    """
+    match = UNIX_LIST_LINE.match(line)
+    if match:
+        if match['type'] != '-':
+            return None
+        month = MONTHS.index(match['month'].lower()) + 1
+        if ':' in match['time']:
+            hour, minute = match['time'].split(':')
+            modified_time = datetime(now.year, month, int(match['day']), int(hour), int(minute))
+            # Recent entries come without a year, those that would be in the future are from last year
+            if modified_time > now + timedelta(days=1):
+                modified_time = modified_time.replace(year=now.year - 1)
+            precision = 60
+        else:
+            modified_time = datetime(int(match['time']), month, int(match['day']))
+            precision = 24 * 60 * 60
+        return FTPFile(
+            match['name'], int(match['size']), calendar.timegm(modified_time.utctimetuple()) + precision - 1, True)
+    match = DOS_LIST_LINE.match(line)
+    if match:
+        if match['size'] == '<DIR>':
+            return None
+        date_format = '%m-%d-%Y' if len(match['date']) == 10 else '%m-%d-%y'
+        modified_time = datetime.strptime(f'{match["date"]} {match["time"]}', f'{date_format} %I:%M%p')
+        return FTPFile(match['name'], int(match['size']), calendar.timegm(modified_time.utctimetuple()) + 59, True)
+    raise FTPListingException(f'Unknown LIST line format: {line}')
+
+
+def list_command_files(connection):
+    lines = []
+    connection.retrlines('LIST', lines.append)
+    now = datetime.utcnow()
+    files = [parse_list_line(line, now) for line in lines if line.strip() and not line.startswith('total ')]
+    return [file for file in files if file is not None]
+
+
+def nlst_files(connection):
+    files = []
+    for file in connection.nlst():
         if file in [".", ".."]:
             continue
         modified_time = parser.parse(connection.voidcmd('MDTM {}'.format(file))[4:].strip())
-        timestamp = datetime.timestamp(modified_time)
-        if file_should_be_downloaded(file, timestamp, last_successful_sync):
-            csv_readers.append(get_reader_from_ftp(connection, file))
-    connection.quit()
-    return list(filter(None, csv_readers))
+        files.append(FTPFile(file, None, datetime.timestamp(modified_time)))
+    return files
+
+
+def mdtm_timestamp(connection, filename):
+    """UTC modification timestamp of filename from MDTM, or None if the server can't tell."""
+    try:
+        response = connection.voidcmd('MDTM {}'.format(filename))
+        # "213 YYYYMMDDHHMMSS" optionally followed by fractions of a second
+        modified_time = datetime.strptime(response[4:18], '%Y%m%d%H%M%S')
+    except (error_perm, error_reply, ValueError):
+        return None
+    return calendar.timegm(modified_time.utctimetuple())
+
+
+def utc_timestamp(connection, file, last_successful_sync):
+    """
+    Modification timestamp of file to compare with last_successful_sync. LIST times are in the local
+    time of the server, they are only trusted when they are further than any UTC offset from
+    last_successful_sync. Closer ones are confirmed with MDTM, files the server can't tell the UTC
+    time of are left to the fingerprint check.
+    """
+    if not file.local_time or last_successful_sync is None:
+        return file.timestamp
+    last_success_timestamp = calendar.timegm(last_successful_sync.utctimetuple())
+    if abs(file.timestamp - last_success_timestamp) > MAX_UTC_OFFSET:
+        return file.timestamp
+    timestamp = mdtm_timestamp(connection, file.name)
+    return timestamp if timestamp is not None else float('inf')
+
+
+def list_ftp_files(connection):
+    """
+    Lists the files of the working directory with their sizes and modification timestamps. MLSD
+    returns all of them in one command. Servers without MLSD are listed with LIST, and servers with
+    a LIST format that can't be parsed with NLST plus one MDTM per file.
+    """
+    try:
+        return mlsd_files(connection)
+    except (error_perm, error_reply, KeyError, ValueError) as e:
+        current_app.logger.info(f'MLSD listing not available ({e}), falling back to LIST')
+    try:
+        return list_command_files(connection)
+    except (error_perm, error_reply, FTPListingException, ValueError) as e:
+        current_app.logger.info(f'LIST listing not available ({e}), falling back to NLST and MDTM')
+    return nlst_files(connection)
+
+
+def new_ftp_files(connection, path, last_successful_sync, known_fingerprints=()):
+    """(FTPFile, fingerprint) of the files in the working directory of connection to download."""
+    new_files = []
+    for file in list_ftp_files(connection):
+        fingerprint = file_fingerprint('ftp', os.path.join(path or '', file.name), file.size, file.timestamp)
+        # Processed files are skipped whatever their time, they don't need an MDTM
+        timestamp = file.timestamp if fingerprint in known_fingerprints else utc_timestamp(
+            connection, file, last_successful_sync)
+        if file_should_be_downloaded(file.name, timestamp, last_successful_sync, fingerprint, known_fingerprints):
+            new_files.append((file, fingerprint))
+    return new_files
+
+
+def get_files_in_ftp_url(
+        host,
+        username=None,
+        password=None,
+        path='.',
+        port=21,
+        last_successful_sync=None,
+        known_fingerprints=(),
+        max_workers=1,
+        encoding_hint=None):
+    current_app.logger.info('Getting files from {}, path: {}'.format(host, path))
+    port = port if port is not None else 21
+    connection = connect_ftp(host, port, username, password, path)
+    try:
+        downloads = [
+            (file.name, fingerprint, encoding_hint,
+             'ftp://{}:{}/{}'.format(host, port, os.path.join(path or '', file.name)), file.size)
+            for file, fingerprint in new_ftp_files(connection, path, last_successful_sync, known_fingerprints)
+        ]
+    finally:
+        connection.quit()
+
+    # A single FTP control connection can only run one transfer at a time, so each worker gets a
+    # connection of its own. A connection whose transfer failed is replaced.
+    connections = ftp_connection_pool(host, port, username, password, path)
+    try:
+        for fetched_file in ordered_map(
+                lambda download: get_reader_from_ftp(connections, *download), downloads, max_workers):
+            if fetched_file:
+                yield fetched_file
+    finally:
+        connections.close()
@@ -1,7 +1,12 @@
 import csv
+import codecs
 import os
 import hashlib
 import base64
+import itertools
+import tempfile
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cchardet as chardet
 from pythonjsonlogger import jsonlogger
@@ -10,23 +15,258 @@ from flask import current_app
 from google.api_core.exceptions import InvalidArgument
 
 CURRENT_PROCESSING_CONFIG = 'CURRENT_PROCESSING_CONFIG'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Downloads are kept in memory up to this size and rolled over to a temporary file beyond it.
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
 
+# Encodings are detected from the first ENCODING_SAMPLE_SIZE bytes of a file
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# UTF-32 BOMs go first, the UTF-32 LE BOM starts with the UTF-16 LE BOM
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, 'UTF-32'),
+    (codecs.BOM_UTF32_BE, 'UTF-32'),
+    (codecs.BOM_UTF8, 'UTF-8-SIG'),
+    (codecs.BOM_UTF16_LE, 'UTF-16'),
+    (codecs.BOM_UTF16_BE, 'UTF-16'),
+]
+# Decodes any bytes, used for files that don't decode as the encoding detected on the whole file
+FALLBACK_ENCODING = 'latin-1'
 
-def detect_encoding(data):
+FetchedFile = namedtuple(
+    'FetchedFile', ['reader', 'md5', 'filename', 'fingerprint', 'encoding', 'modified_at', 'size'],
+    defaults=[None, None, None, None])
+
+
+def bom_encoding(data):
+    for bom, encoding in BOM_ENCODINGS:
+        if data.startswith(bom):
+            return encoding
+    return None
+
+
+def decodes_as(data, encoding):
+    try:
+        # Not final, the sample may end in the middle of a multibyte character
+        codecs.getincrementaldecoder(encoding)().decode(data, final=False)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+def is_unicode_encoding(encoding):
+    return encoding.upper().startswith('UTF')
+
+
+def hint_fits_sample(data, encoding_hint):
+    if not decodes_as(data, encoding_hint):
+        return False
+    if data.isascii() or is_unicode_encoding(encoding_hint):
+        return True
+    # Single byte encodings decode anything, non-ASCII data that is valid UTF-8 is most likely UTF-8
+    return not decodes_as(data, 'utf-8')
+
+
+def detect_encoding(data, encoding_hint=None):
+    """
+    Encoding of data, usually a sample of a file: the BOM encoding if there is one, else encoding_hint
+    (e.g. the encoding of the previous file of the same config) if the data fits it, else cchardet.
+    """
+    encoding = bom_encoding(data)
+    if encoding:
+        return encoding
+    if encoding_hint and hint_fits_sample(data, encoding_hint):
+        return encoding_hint
     encoding = chardet.detect(data)['encoding']
     current_app.logger.info('Detected encoding {}'.format(encoding))
     return encoding
 
 
 def get_csv_reader(data):
+    lines = iter(data)
+    first_line = next(lines)
     sniffer = csv.Sniffer()
-    dialect = sniffer.sniff(data[0])
-    return csv.DictReader(data, dialect=dialect)
+    dialect = sniffer.sniff(first_line)
+    return csv.DictReader(itertools.chain([first_line], lines), dialect=dialect)
+
+
+def iter_decoded_lines(file_object, encoding, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Decodes a binary file object chunk by chunk and yields its lines without line terminators,
+    the same way bytes.decode(encoding).splitlines() would but without holding the whole file.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    while True:
+        chunk = file_object.read(chunk_size)
+        text = pending + decoder.decode(chunk, final=not chunk)
+        # The last line of a chunk may continue in the next one (or be a \r of a split \r\n)
+        lines = text.splitlines(True)
+        pending = lines[-1] if chunk and lines else ''
+        yield from text[:len(text) - len(pending)].splitlines()
+        if not chunk:
+            return
+
+
+class HashingSpool:
+    """
+    Write-only file-like sink for downloads. Bytes are spooled to a temporary file while the MD5 and
+    the encoding of the content are computed in the same pass.
+
+    The encoding is detected on the first ENCODING_SAMPLE_SIZE bytes and the rest of the data is
+    verified against it as it arrives. Only if that verification fails is the whole file run through
+    cchardet. Single byte encodings decode any data, so while one is used the data is also checked
+    for UTF-8 and a file that turns out to be non-ASCII UTF-8 is read as UTF-8.
+    """
+
+    def __init__(self, encoding_hint=None):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.size = 0
+        self.encoding_hint = encoding_hint
+        self._md5 = hashlib.md5()
+        self._sample = bytearray()
+        self._sampling = True
+        self._encoding = None
+        self._verifier = None
+        self._verified = False
+        self._utf8_checker = None
+        self._utf8_valid = False
+        self._non_ascii = False
+
+    def write(self, data):
+        self._md5.update(data)
+        self.size += len(data)
+        if self._sampling:
+            self._sample += data
+            if len(self._sample) >= ENCODING_SAMPLE_SIZE:
+                self._start_verification()
+        else:
+            self._verify(data)
+            self._check_utf8(data)
+        return self.file.write(data)
+
+    def _start_verification(self):
+        self._sampling = False
+        self._encoding = detect_encoding(bytes(self._sample[:ENCODING_SAMPLE_SIZE]), self.encoding_hint)
+        if self._encoding is not None:
+            self._verifier = codecs.getincrementaldecoder(self._encoding)()
+            self._verified = True
+            self._verify(bytes(self._sample), final=False)
+            if not is_unicode_encoding(self._encoding):
+                self._utf8_checker = codecs.getincrementaldecoder('utf-8')()
+                self._utf8_valid = True
+                self._check_utf8(bytes(self._sample))
+        self._sample = bytearray()
+
+    def _verify(self, data, final=False):
+        if not self._verified:
+            return
+        try:
+            self._verifier.decode(data, final=final)
+        except UnicodeDecodeError:
+            self._verified = False
+
+    def _check_utf8(self, data, final=False):
+        if not self._utf8_valid:
+            return
+        self._non_ascii = self._non_ascii or not data.isascii()
+        try:
+            self._utf8_checker.decode(data, final=final)
+        except UnicodeDecodeError:
+            self._utf8_valid = False
+
+    def _decodes_whole_file(self, encoding):
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            self.file.seek(0)
+            for chunk in iter(lambda: self.file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except (UnicodeDecodeError, LookupError):
+            return False
+        return True
+
+    def _detect_whole_file(self):
+        detector = chardet.UniversalDetector()
+        self.file.seek(0)
+        for chunk in iter(lambda: self.file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            detector.feed(chunk)
+            if detector.done:
+                break
+        detector.close()
+        encoding = detector.result['encoding']
+        current_app.logger.info('Detected encoding {} from the whole file'.format(encoding))
+        # The detector stops once it is confident, which it can be about an encoding the rest of the file breaks
+        if encoding is None or not self._decodes_whole_file(encoding):
+            current_app.logger.info(f'File does not decode as {encoding}, reading it as {FALLBACK_ENCODING}')
+            encoding = FALLBACK_ENCODING
+        return encoding
+
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def encoding(self):
+        if self._sampling:
+            self._start_verification()
+        self._verify(b'', final=True)
+        self._check_utf8(b'', final=True)
+        if self._utf8_valid and self._non_ascii:
+            current_app.logger.info(f'File decodes as UTF-8, reading it as UTF-8 instead of {self._encoding}')
+            self._encoding = 'UTF-8'
+            self._verified = True
+            self._utf8_valid = False
+        elif not self._verified:
+            current_app.logger.info(f'File does not decode as {self._encoding}, detecting encoding on the whole file')
+            self._encoding = self._detect_whole_file()
+            self._verified = True
+        return self._encoding
+
+    def lines(self, encoding):
+        self.file.seek(0)
+        return iter_decoded_lines(self.file, encoding)
+
+
+def ordered_map(func, items, max_workers=1):
+    """
+    Lazily yields func(item) for every item, in the order of items. With max_workers > 1 up to
+    max_workers calls run concurrently in threads that share the current app context.
+    """
+    if max_workers is None or max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    app = current_app._get_current_object()
+
+    def run_in_app_context(item):
+        with app.app_context():
+            return func(item)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(run_in_app_context, item))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def file_fingerprint(*parts):
+    """
+    Cheap identity of a remote file built from listing metadata (e.g. path, size and mtime or ETag),
+    used to skip files that were already processed before downloading them.
+    """
+    return ':'.join(str(part) for part in parts)
 
 
-def bytesio_md5(data):
-    m = hashlib.md5(data)
-    return m.hexdigest()
+def get_reader_from_spool(spool, filename, fingerprint=None):
+    if spool.size > 0:
+        encoding = spool.encoding()
+        return FetchedFile(
+            get_csv_reader(spool.lines(encoding)), spool.md5(), filename, fingerprint, encoding, size=spool.size)
+    else:
+        current_app.logger.info('Empty file: {}'.format(filename))
+        return None
 
 
 class ConfigVariableHelper:
@@ -1,20 +1,61 @@
 import requests
-from app.helpers import bytesio_md5, get_csv_reader, detect_encoding
+from urllib.parse import urlparse
+from flask import current_app
+from app.compression import decompressing_writer
+from app.helpers import HashingSpool, get_reader_from_spool, file_fingerprint, DOWNLOAD_CHUNK_SIZE
+from app.download_cache import cached_download
 
 
 class HTTPDownloadException(Exception):
     pass
 
 
-def get_file_from_url(url):
-    response = requests.get(url)
-    if response.ok:
-        content = response.content
-        encoding = detect_encoding(content)
-        md5 = bytesio_md5(content)
-        csv_reader = get_csv_reader(content.decode(encoding).splitlines())
-        return (csv_reader, md5, url)
-    else:
-        raise HTTPDownloadException(
-            "Error in downloading file from '{}': status {}, body: {}".format(
-                url, response.status_code, response.content))
+def conditional_headers(url, validators):
+    """If-None-Match and If-Modified-Since headers from the validators of an earlier download of url."""
+    if not validators or validators.get('url') != url:
+        return {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def response_validators(url, response):
+    return {'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def http_fingerprint(validators):
+    if not validators['etag'] and not validators['last_modified']:
+        return None
+    return file_fingerprint('http', validators['etag'], validators['last_modified'])
+
+
+def stream_response(response, writer):
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        writer.write(chunk)
+
+
+def get_file_from_url(url, encoding_hint=None, validators=None):
+    """
+    Downloads url with a conditional request when there are validators (ETag and Last-Modified) of an
+    earlier download of the same url. Returns the fetched file, or None when the server answers that
+    the file did not change, along with the validators to send next time. When a cached copy matches
+    the validators of the response, the body is not downloaded.
+    """
+    with requests.get(url, headers=conditional_headers(url, validators), stream=True) as response:
+        if response.status_code == 304:
+            current_app.logger.info(f'File at {url} not modified since the last download')
+            return None, validators
+        elif response.ok:
+            new_validators = response_validators(url, response)
+            fingerprint = http_fingerprint(new_validators)
+            spool = HashingSpool(encoding_hint)
+            with decompressing_writer(urlparse(url).path, spool) as writer:
+                cached_download(url, fingerprint, lambda raw_writer: stream_response(response, raw_writer), writer)
+            return get_reader_from_spool(spool, url, fingerprint), new_validators
+        else:
+            raise HTTPDownloadException(
+                "Error in downloading file from '{}': status {}, body: {}".format(
+                    url, response.status_code, response.content))
@@ -0,0 +1,18 @@
+from datetime import datetime
+from functools import lru_cache
+from liquid import Environment
+
+TEMPLATE_CACHE_SIZE = 1024
+
+# Shared by every render so custom filters are registered only once per process
+environment = Environment()
+environment.add_filter('fromtimestamp', datetime.fromtimestamp)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_template(source):
+    return environment.from_string(source)
+
+
+def render(source, **context):
+    return get_template(source).render(**context)
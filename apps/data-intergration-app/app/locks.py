@@ -0,0 +1,74 @@
+import threading
+import uuid
+from flask import current_app
+
+# Renews or deletes the lease only while it is still held with our token
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+LEASE_TTL_MS = 60 * 1000
+
+
+class LeaseLock:
+    """
+    Redis lease held by one owner at a time: SET NX PX with a random token, renewed by a heartbeat
+    thread every third of the TTL while held. Renewal and release compare the token first, so an owner
+    never extends or releases a lease that expired and was taken by someone else. When the owner
+    crashes its heartbeat stops with it and the lease expires after ttl_ms.
+    """
+
+    def __init__(self, redis, key, ttl_ms=LEASE_TTL_MS):
+        self.redis = redis
+        self.key = key
+        self.ttl_ms = ttl_ms
+        self.token = uuid.uuid4().hex
+        self.lost = False
+        self._renew = redis.register_script(RENEW_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        if not self.redis.set(self.key, self.token, nx=True, px=self.ttl_ms):
+            return False
+        app = current_app._get_current_object()
+        self._heartbeat = threading.Thread(target=self._keep_alive, args=(app,), daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _keep_alive(self, app):
+        while not self._stopped.wait(self.ttl_ms / 3000):
+            try:
+                renewed = self._renew(keys=[self.key], args=[self.token, self.ttl_ms])
+            except Exception as e:
+                # Retried on the next beat, the lease is only lost once it expires
+                with app.app_context():
+                    current_app.logger.info(f'Failed to renew lease {self.key}: {e}')
+                continue
+            if not renewed:
+                self.lost = True
+                with app.app_context():
+                    current_app.logger.warning(f'Lease {self.key} was lost')
+                return
+
+    def release(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        self._release(keys=[self.key], args=[self.token])
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        if self._heartbeat is not None:
+            self.release()
@@ -1,6 +1,6 @@
 import datetime
 from sqlalchemy.orm import validates, relationship
-from sqlalchemy import or_
+from sqlalchemy import or_, func, event, inspect
 from flask_sqlalchemy import SQLAlchemy
 from app.parsers.example_server_to_server import ExampleServerToServerParser
 
@@ -16,6 +16,9 @@ class BaseProcessingConfig:
     last_processing_started_at = db.Column(db.DateTime)
     last_processed_at = db.Column(db.DateTime, index=True)
     last_successfully_processed_at = db.Column(db.DateTime)
+    # Adaptive polling: configs are due from next_sync_at on, poll_interval_seconds grows while no files arrive
+    next_sync_at = db.Column(db.DateTime, index=True)
+    poll_interval_seconds = db.Column(db.Integer)
 
     @validates('import_type')
     def validate_import_type(self, key, import_type):
@@ -34,8 +37,8 @@ class BaseProcessingConfig:
         if force:
             return cls.query.all()
         else:
-            ten_minutes_ago = datetime.datetime.now() - datetime.timedelta(seconds=10*60)
-            return cls.query.filter(or_(cls.last_processed_at < ten_minutes_ago, cls.last_processed_at.is_(None))).all()
+            now = datetime.datetime.now()
+            return cls.query.filter(or_(cls.next_sync_at <= now, cls.next_sync_at.is_(None))).all()
 
 
 class ProcessingConfig(db.Model, BaseProcessingConfig):
@@ -49,6 +52,17 @@ class ProcessingConfig(db.Model, BaseProcessingConfig):
     parser_class = db.Column(db.String, nullable=False)
     field_mapping = db.Column(db.JSON, nullable=True)
     s2s_token = db.Column(db.String, nullable=True)
+    # Number of files downloaded in parallel from the source
+    download_concurrency = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    last_detected_encoding = db.Column(db.String)
+    # Newest modification time of the source files seen by the last successful sync
+    last_seen_modified_at = db.Column(db.DateTime)
+    # Overrides of the S3 download TransferConfig, e.g. {"max_concurrency": 32, "multipart_chunksize": 8388608}
+    s3_transfer_config = db.Column(db.JSON, nullable=True)
+    # URL, ETag and Last-Modified of the last successfully processed HTTP download, for conditional requests
+    http_validators = db.Column(db.JSON, nullable=True)
+    # Bumped whenever the definition of the config changes, not on updates of the sync state
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
     processing_entries = relationship(
         'ProcessingEntry',
         backref="processing_config",
@@ -56,6 +70,13 @@ class ProcessingConfig(db.Model, BaseProcessingConfig):
         passive_deletes=True,
     )
 
+    # Columns written by the syncs themselves
+    STATE_COLUMNS = [
+        'last_processing_started_at', 'last_processed_at', 'last_successfully_processed_at',
+        'last_detected_encoding', 'last_seen_modified_at', 'http_validators',
+        'next_sync_at', 'poll_interval_seconds',
+    ]
+
     def __repr__(self):
         return f'ProcessingConfig (file-based): {self.id} - {self.customer}'
 
@@ -67,6 +88,17 @@ class ProcessingConfig(db.Model, BaseProcessingConfig):
                 'Parser {} is not implemented'.format(self.parser_class))
 
 
+@event.listens_for(ProcessingConfig, 'before_update')
+def bump_config_version(mapper, connection, config):
+    state = inspect(config)
+    definition_columns = [
+        column.key for column in mapper.column_attrs
+        if column.key not in ProcessingConfig.STATE_COLUMNS + ['id', 'version']
+    ]
+    if any(state.attrs[key].history.has_changes() for key in definition_columns):
+        config.version = (config.version or 0) + 1
+
+
 class BaseProcessingEntry:
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.String, nullable=False)
@@ -88,9 +120,72 @@ class ProcessingEntry(db.Model, BaseProcessingEntry):
     )
     file_url = db.Column(db.String, nullable=False)
     file_md5 = db.Column(db.String, nullable=False, index=True)
+    file_fingerprint = db.Column(db.String, index=True)
+    # Size of the downloaded (decompressed) file in bytes
+    file_size = db.Column(db.BigInteger)
+    # Start of the sync the file was processed in, entries of a sync share it
+    sync_started_at = db.Column(db.DateTime)
+
+    @classmethod
+    def get_processed_md5s_and_fingerprints(cls, config_id):
+        entries = db.session.query(cls.file_md5, cls.file_fingerprint).filter_by(config_id=config_id) \
+            .filter(cls.status.in_(['succeeded', 'started'])).all()
+        return {entry.file_md5 for entry in entries}, \
+            {entry.file_fingerprint for entry in entries if entry.file_fingerprint is not None}
+
+    @classmethod
+    def get_sync_costs(cls, config_ids, since):
+        """
+        Per config, the average and maximum seconds, bytes and rows of the syncs that processed files
+        since since. A sync takes from its start to the end of its last file, so listing and downloads
+        are included. Entries from before sync_started_at existed count as a sync each.
+        """
+        sync = func.coalesce(cls.sync_started_at, cls.started_at)
+        syncs = db.session.query(
+            cls.config_id.label('config_id'),
+            func.extract('epoch', func.max(cls.finished_at) - sync).label('seconds'),
+            func.sum(cls.file_size).label('bytes'),
+            func.sum(cls.output_rows_generated).label('rows'),
+        ).filter(cls.config_id.in_(config_ids)) \
+            .filter(cls.started_at >= since) \
+            .filter(cls.finished_at.isnot(None)) \
+            .group_by(cls.config_id, sync).subquery()
+        return db.session.query(
+            syncs.c.config_id,
+            func.count().label('syncs'),
+            func.avg(syncs.c.seconds).label('avg_seconds'),
+            func.max(syncs.c.seconds).label('max_seconds'),
+            func.avg(syncs.c.bytes).label('avg_bytes'),
+            func.avg(syncs.c.rows).label('avg_rows'),
+        ).group_by(syncs.c.config_id).all()
+
+    @classmethod
+    def get_arrival_times(cls, config_ids, since):
+        """Per config id, the sorted start times of the syncs that found files since since."""
+        arrivals = {config_id: [] for config_id in config_ids}
+        if not config_ids:
+            return arrivals
+        sync = func.coalesce(cls.sync_started_at, cls.started_at)
+        rows = db.session.query(cls.config_id, sync.label('arrived_at')).filter(cls.config_id.in_(config_ids)) \
+            .filter(cls.started_at >= since) \
+            .distinct().order_by(sync).all()
+        for row in rows:
+            arrivals[row.config_id].append(row.arrived_at)
+        return arrivals
 
     @classmethod
-    def get_old_processing_entries_by_config_and_md5(cls, config_id, new_md5s):
-        return cls.query.filter_by(config_id=config_id) \
+    def get_processed_fingerprints_by_config(cls, candidates):
+        """Per config id, which of the candidate fingerprints of that config were already processed."""
+        fingerprints = {config_id: set() for config_id in candidates}
+        candidate_fingerprints = {
+            fingerprint for config_fingerprints in candidates.values() for fingerprint in config_fingerprints
+            if fingerprint is not None}
+        if not candidate_fingerprints:
+            return fingerprints
+        entries = db.session.query(cls.config_id, cls.file_fingerprint).filter(cls.config_id.in_(list(candidates))) \
             .filter(cls.status.in_(['succeeded', 'started'])) \
-            .filter(cls.file_md5.in_(new_md5s)).all()
+            .filter(cls.file_fingerprint.in_(candidate_fingerprints)).all()
+        for entry in entries:
+            if entry.file_fingerprint in candidates[entry.config_id]:
+                fingerprints[entry.config_id].add(entry.file_fingerprint)
+        return fingerprints
@@ -2,7 +2,7 @@ import requests
 from urllib3.util.retry import Retry
 import simplejson as json
 from flask import current_app
-from app.helpers import ConfigVariableHelper
+from app.helpers import ConfigVariableHelper, ordered_map
 import os
 
 
@@ -14,11 +14,14 @@ class MultiplatformServerToServerSender:
     API_URL = '[FILL ME IN S2S ENDPOINT]'
     REQUIRED_FIELDS = ['platform', 'ad_unit_id', 'event_name', 'ad_interaction_time']
     OPTIONAL_FIELDS = ['event_time', 'install_time', 'conversions', 'value', 'value_currency']
+    # Number of requests in flight at the same time
+    CONCURRENCY = 10
 
-    def __init__(self, data, api_token_env_variable, s2s_token=None):
+    def __init__(self, data, api_token_env_variable, s2s_token=None, concurrency=None):
         self.events = data
         self.api_token_env_variable = api_token_env_variable
         self.s2s_token = s2s_token
+        self.concurrency = concurrency or self.CONCURRENCY
 
     def send(self):
         current_app.logger.info('Sending conversion events to S2S endpoint')
@@ -32,22 +35,27 @@ class MultiplatformServerToServerSender:
 
         successes = 0
         failures = 0
-        for row in self.events:
-            self.to_multiplatform_s2s_event(row)
-            response = session.post(self.API_URL, data=json.dumps(row), headers=headers)
-            if response.ok:
+        for sent in ordered_map(lambda row: self.send_event(session, headers, row), self.events, self.concurrency):
+            if sent:
                 successes += 1
             else:
                 failures += 1
-                error_message = response.json().get('message')
-                current_app.logger.error(
-                        f'Failed to send S2S event! Status: {response.status_code} Msg: {error_message} '
-                        f'Id:{row.get("ad_unit_id")} Date:{row.get("ad_interaction_time")}')
 
         current_app.logger.info(
-            f'{successes}/{len(self.events)} S2S events sent successfully')
+            f'{successes}/{successes + failures} S2S events sent successfully')
         return {'successes': successes, 'failures': failures}
 
+    def send_event(self, session, headers, row):
+        self.to_multiplatform_s2s_event(row)
+        response = session.post(self.API_URL, data=json.dumps(row), headers=headers)
+        if response.ok:
+            return True
+        error_message = response.json().get('message')
+        current_app.logger.error(
+                f'Failed to send S2S event! Status: {response.status_code} Msg: {error_message} '
+                f'Id:{row.get("ad_unit_id")} Date:{row.get("ad_interaction_time")}')
+        return False
+
     def to_multiplatform_s2s_event(self, row):
         for field in self.REQUIRED_FIELDS:
             if row.get(field) is None:
@@ -61,9 +69,11 @@ class MultiplatformServerToServerSender:
         return multiplatform_s2s_event
 
     def retrying_http_session(self):
+        # The connection pool is as large as the in-flight window so every worker keeps its connection alive
         session = requests.Session()
         retries = Retry(total=3, backoff_factor=1, allowed_methods=["POST"])
-        session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retries))
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            max_retries=retries, pool_connections=1, pool_maxsize=self.concurrency))
         return session
 
     def _get_api_token(self):
@@ -0,0 +1,133 @@
+import requests
+from collections import defaultdict
+from urllib.parse import urlparse
+from flask import current_app
+from app.ftp import connect_sftp, connect_ftp, new_sftp_files, new_ftp_files, ThreadLocalPool
+from app.http import conditional_headers, response_validators
+from app.liquid_templates import render
+from app.models import ProcessingEntry
+from app.s3 import s3_resource, new_s3_objects, s3_fingerprint
+
+
+def probe_group(config):
+    """Configs with the same group share a connection (or an HTTP session) while they are probed."""
+    parsed_url = urlparse(config.file_url)
+    if parsed_url.scheme in ['sftp', 'ftp']:
+        return (parsed_url.scheme, parsed_url.hostname, config.connection_port,
+                config.connection_username, config.connection_password)
+    elif 's3' in parsed_url.scheme:
+        return ('s3', config.connection_username)
+    elif 'http' in parsed_url.scheme:
+        return ('http', parsed_url.hostname)
+    return ('other', config.id)
+
+
+def group_configs(configs):
+    """Lists of configs with the same probe_group."""
+    groups = defaultdict(list)
+    for config in configs:
+        groups[probe_group(config)].append(config)
+    return list(groups.values())
+
+
+# Listing probes return, by config id, the fingerprints of the files a sync would download unless they were
+# already processed. The processed ones are looked up afterwards for those candidates only.
+def probe_sftp(configs):
+    first = configs[0]
+    port = first.connection_port if first.connection_port is not None else 22
+    changes = {}
+    with connect_sftp(urlparse(first.file_url).hostname, port,
+                      first.connection_username, first.connection_password) as sftp:
+        home = sftp.pwd
+        channels = ThreadLocalPool(lambda: sftp, lambda channel: None)
+        for config in configs:
+            sftp.cwd(home)
+            if config.connection_path is not None:
+                sftp.cwd(config.connection_path)
+            changes[config.id] = [fingerprint for _, _, fingerprint in new_sftp_files(
+                channels, config.connection_path, config.last_successfully_processed_at, config.check_subdirs)]
+    return changes
+
+
+def probe_ftp(configs):
+    first = configs[0]
+    port = first.connection_port if first.connection_port is not None else 21
+    changes = {}
+    connection = connect_ftp(
+        urlparse(first.file_url).hostname, port, first.connection_username, first.connection_password, '.')
+    try:
+        home = connection.pwd()
+        for config in configs:
+            connection.cwd(home)
+            connection.cwd(config.connection_path or '.')
+            changes[config.id] = [fingerprint for _, fingerprint in new_ftp_files(
+                connection, config.connection_path, config.last_successfully_processed_at)]
+    finally:
+        connection.quit()
+    return changes
+
+
+def probe_s3(configs):
+    client = s3_resource(configs[0].connection_username).meta.client
+    changes = {}
+    for config in configs:
+        parsed_url = urlparse(config.file_url)
+        changes[config.id] = [s3_fingerprint(item) for item in new_s3_objects(
+            client, parsed_url.netloc, parsed_url.path, config.last_successfully_processed_at,
+            (), config.download_concurrency or 1, config.last_seen_modified_at)]
+    return changes
+
+
+def http_file_changed(session, config):
+    """
+    HEAD request with the validators of the last download. The file changed unless the server answers
+    304 or the same ETag or Last-Modified, servers that don't support HEAD are left to the sync.
+    """
+    url = render(config.file_url)
+    validators = config.http_validators
+    response = session.head(url, headers=conditional_headers(url, validators), allow_redirects=True)
+    if response.status_code == 304:
+        return False
+    if not response.ok or not conditional_headers(url, validators):
+        return True
+    new_validators = response_validators(url, response)
+    if new_validators['etag'] and new_validators['etag'] == validators.get('etag'):
+        return False
+    if new_validators['last_modified'] and new_validators['last_modified'] == validators.get('last_modified'):
+        return False
+    return True
+
+
+def probe_http(configs):
+    with requests.Session() as session:
+        return {config.id: http_file_changed(session, config) for config in configs}
+
+
+def unprocessed_files(candidates):
+    """Whether each config has candidate fingerprints that were not processed yet, by config id."""
+    processed = ProcessingEntry.get_processed_fingerprints_by_config(candidates)
+    return {
+        config_id: any(fingerprint not in processed[config_id] for fingerprint in fingerprints)
+        for config_id, fingerprints in candidates.items()
+    }
+
+
+def probe_configs(configs):
+    """
+    Lists the sources of configs of one probe group, without downloading anything, and returns whether
+    each of them has files that a sync would process, by config id.
+    """
+    scheme = probe_group(configs[0])[0]
+    probe = {'sftp': probe_sftp, 'ftp': probe_ftp, 's3': probe_s3}.get(scheme)
+    if scheme != 'http' and probe is None:
+        # Nothing to probe, the sync reports the unsupported url
+        return {config.id: True for config in configs}
+    try:
+        if scheme == 'http':
+            return probe_http(configs)
+        candidates = probe(configs)
+    except Exception as e:
+        # The sync gets to retry and record the error
+        current_app.logger.info(f'Probing {scheme} configs {[config.id for config in configs]} failed: {e}')
+        return {config.id: True for config in configs}
+    return unprocessed_files(candidates)
@@ -1,12 +1,21 @@
 from app.models import ProcessingConfig
-from app.tasks import sync_config
+from app.probe import group_configs
+from app.tasks import sync_job_pending, queue_sync_jobs, queue_probe_job
 from flask import current_app
 
 
 def produce_sync_tasks(force=False):
     configs = ProcessingConfig.get_syncable_configs(force=force)
     current_app.logger.info('Got {} configs. Producing tasks...'.format(len(configs)))
-    for config in configs:
-        # TODO: reduce timeout down once backfill for Binance.com is done
-        sync_config.queue(config, timeout='12h')
+    pending = [config for config in configs if sync_job_pending(config.id)]
+    if pending:
+        current_app.logger.info(f'Syncs of configs {[config.id for config in pending]} are already queued or running')
+    configs = [config for config in configs if config not in pending]
+    if force:
+        # Forced syncs run whether or not the sources changed
+        queue_sync_jobs(configs)
+    else:
+        # Probes connect to the sources, each host is probed in a job of its own that queues the syncs
+        for group in group_configs(configs):
+            queue_probe_job(group)
     return len(configs)
@@ -0,0 +1,211 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+import uuid
+from flask import current_app
+from app.helpers import DOWNLOAD_CHUNK_SIZE, ordered_map
+
+# Downloads are resumable when this is set: partial files are kept there between attempts
+DOWNLOAD_SPOOL_DIR = 'DOWNLOAD_SPOOL_DIR'
+DOWNLOAD_ATTEMPTS = 3
+# Partial downloads that were not touched for this long are abandoned
+PARTIAL_DOWNLOAD_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class IncompleteDownloadException(Exception):
+    pass
+
+
+def partial_download(source, fingerprint, size=None):
+    """PartialDownload of source in DOWNLOAD_SPOOL_DIR, or None when downloads are not resumable."""
+    spool_dir = os.getenv(DOWNLOAD_SPOOL_DIR)
+    if not spool_dir:
+        return None
+    os.makedirs(spool_dir, exist_ok=True)
+    remove_stale_partial_downloads(spool_dir)
+    return PartialDownload(spool_dir, source, fingerprint, size)
+
+
+def remove_stale_partial_downloads(spool_dir, max_age=PARTIAL_DOWNLOAD_MAX_AGE):
+    for name in os.listdir(spool_dir):
+        path = os.path.join(spool_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def with_retries(func, description, on_retry=None):
+    """Calls func up to DOWNLOAD_ATTEMPTS times, on_retry() before each new attempt (e.g. to reconnect)."""
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            current_app.logger.info(f'Attempt {attempt} to download {description} failed, resuming: {e}')
+            if on_retry:
+                on_retry()
+            time.sleep(2 ** attempt)
+
+
+class PartialDownload:
+    """
+    Raw bytes of a remote file persisted in a spool directory as they arrive, so a failed download
+    can continue where it stopped instead of starting from byte zero, in this or a later sync.
+
+    The bytes go to <key>.part and the metadata to <key>.json: the fingerprint of the remote file,
+    its size and, for files fetched as ranged parts, the parts that are complete. A partial file of
+    a different fingerprint (the remote file changed) is discarded.
+
+    The key is derived from the source and locked with flock on <key>.lock until close(). When another
+    download of the same source holds it, e.g. a sync of another config reading the same remote file,
+    this one uses files of its own that are removed on close(), so the two never write the same file.
+    """
+
+    def __init__(self, spool_dir, source, fingerprint, size=None):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.size = size
+        key = hashlib.sha1(source.encode()).hexdigest()
+        self.shared = True
+        self._lock_file = self._lock(spool_dir, key)
+        if self._lock_file is None:
+            current_app.logger.info(f'{source} is being downloaded by someone else, downloading it separately')
+            key = f'{key}-{uuid.uuid4().hex}'
+            self.shared = False
+            self._lock_file = self._lock(spool_dir, key)
+        self.part_path = os.path.join(spool_dir, key + '.part')
+        self.metadata_path = os.path.join(spool_dir, key + '.json')
+        self.completed_parts = set()
+        metadata = self._load_metadata()
+        if metadata.get('fingerprint') == fingerprint and os.path.exists(self.part_path):
+            self.completed_parts = set(metadata.get('completed_parts', []))
+        else:
+            self.remove()
+            self._save_metadata()
+        open(self.part_path, 'ab').close()
+
+    @staticmethod
+    def _lock(spool_dir, key):
+        lock_file = open(os.path.join(spool_dir, key + '.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        # Keeps the lock file from being removed as stale while it is held
+        os.utime(lock_file.name)
+        return lock_file
+
+    def close(self):
+        """Releases the key, the files of a download that had to use a key of its own are removed."""
+        if self._lock_file is None:
+            return
+        if not self.shared:
+            self.remove()
+            os.remove(self._lock_file.name)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load_metadata(self):
+        try:
+            with open(self.metadata_path) as metadata_file:
+                return json.load(metadata_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_metadata(self):
+        temporary_path = self.metadata_path + '.tmp'
+        with open(temporary_path, 'w') as metadata_file:
+            json.dump({
+                'source': self.source,
+                'fingerprint': self.fingerprint,
+                'size': self.size,
+                'completed_parts': sorted(self.completed_parts),
+            }, metadata_file)
+        os.replace(temporary_path, self.metadata_path)
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.part_path)
+
+    def fetch(self, fetch_from, on_retry=None):
+        """
+        Fetches the file sequentially, fetch_from(offset, write) writes the bytes from offset on.
+        Only bytes that were written end up in the part file, so its size is the resume offset.
+        on_retry() is called before each retry, so the next attempt doesn't use the connection that failed.
+        """
+        def fetch_missing():
+            offset = self.offset
+            if self.size is not None and offset >= self.size:
+                return
+            if offset:
+                current_app.logger.info(f'Resuming download of {self.source} at byte {offset}')
+            with open(self.part_path, 'ab') as part_file:
+                fetch_from(offset, part_file.write)
+
+        with_retries(fetch_missing, self.source, on_retry)
+
+    def fetch_parts(self, fetch_range, part_size, max_workers=1):
+        """
+        Fetches the file as ranged parts, fetch_range(start, end, write) writes the bytes from start to
+        end (exclusive), up to max_workers parts at a time. Each part is streamed to its offset in the
+        part file, and completed parts are checkpointed after each part.
+        """
+        def fetch_part(byte_range):
+            start, end = byte_range
+            with open(self.part_path, 'r+b') as part_file:
+                part_file.seek(start)
+                fetch_range(start, end, part_file.write)
+                length = part_file.tell() - start
+            if length != end - start:
+                raise IncompleteDownloadException(f'Got {length} bytes for range {start}-{end} of {self.source}')
+            return start
+
+        def fetch_missing():
+            missing = [start for start in range(0, self.size, part_size) if start not in self.completed_parts]
+            if len(missing) < len(range(0, self.size, part_size)):
+                current_app.logger.info(f'Resuming download of {self.source}, {len(missing)} parts missing')
+            ranges = [(start, min(start + part_size, self.size)) for start in missing]
+            for start in ordered_map(fetch_part, ranges, max_workers):
+                self.completed_parts.add(start)
+                self._save_metadata()
+
+        with_retries(fetch_missing, self.source)
+
+    def replay(self, target, md5=None):
+        """
+        Verifies the downloaded file against the expected size and, when given, the MD5 of the remote
+        file, then writes it to target and removes the partial download. A file that fails the check
+        is removed as well so the next attempt starts over.
+        """
+        checksum = hashlib.md5()
+        size = self.offset
+        if self.size is not None and size != self.size:
+            self.remove()
+            raise IncompleteDownloadException(f'Downloaded {size} of {self.size} bytes of {self.source}')
+        with open(self.part_path, 'rb') as part_file:
+            for chunk in iter(lambda: part_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                if md5:
+                    checksum.update(chunk)
+                target.write(chunk)
+        self.remove()
+        if md5 and checksum.hexdigest() != md5:
+            raise IncompleteDownloadException(f'Checksum mismatch for {self.source}')
+
+    def remove(self):
+        for path in [self.part_path, self.metadata_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -1,70 +1,232 @@
 import boto3
-import gzip
 import os
-from app.helpers import ConfigVariableHelper, bytesio_md5, detect_encoding
+import shutil
+import tempfile
+import time
+from boto3.s3.transfer import TransferConfig
+from app.compression import decompressing_writer, DecompressionException
+from app.helpers import ConfigVariableHelper, HashingSpool, get_reader_from_spool, file_fingerprint, ordered_map
+from app.helpers import DOWNLOAD_CHUNK_SIZE
+from app.resumable import partial_download
+from app.download_cache import cached_download
 from flask import current_app
-from io import BytesIO
-from app.helpers import get_csv_reader
 from pytz import UTC
 
+MB = 1024 * 1024
+# TransferConfig settings for downloads, a config can override them with s3_transfer_config
+DEFAULT_TRANSFER_SETTINGS = {
+    'multipart_threshold': 64 * MB,
+    'multipart_chunksize': 16 * MB,
+    'max_concurrency': 16,
+    'io_chunksize': DOWNLOAD_CHUNK_SIZE,
+}
+TRANSFER_SETTINGS = [
+    'multipart_threshold', 'multipart_chunksize', 'max_concurrency', 'num_download_attempts',
+    'max_io_queue', 'io_chunksize', 'max_bandwidth'
+]
 
-def download_file_from_s3(bucket, item_key):
-    file_object = BytesIO()
-    bucket.download_fileobj(item_key, file_object)
+
+class S3TransferConfigException(Exception):
+    pass
+
+
+def transfer_settings(overrides=None):
+    overrides = overrides or {}
+    if not isinstance(overrides, dict):
+        raise S3TransferConfigException('s3_transfer_config needs to be a dict')
+    for key, value in overrides.items():
+        if key not in TRANSFER_SETTINGS:
+            raise S3TransferConfigException(f'Invalid setting: "{key}". Allowed settings: {TRANSFER_SETTINGS}')
+        if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+            raise S3TransferConfigException(f'Setting {key} needs to be a positive integer, got {value}')
+    return {**DEFAULT_TRANSFER_SETTINGS, **overrides}
+
+
+def download_file_from_s3(bucket, item_key, file_object, transfer_config=None):
+    bucket.download_fileobj(item_key, file_object, Config=transfer_config)
     return file_object
 
 
-def get_reader_from_bytes(bts, item_key):
-    data = bts.getvalue()
-    if len(data) > 0:
-        encoding = detect_encoding(data)
-        md5 = bytesio_md5(data)
-        csv_data = data.decode(encoding).splitlines()
-        return (get_csv_reader(csv_data), md5, item_key)
+def download_object(bucket, item_key, writer, size, settings=None):
+    """
+    Downloads an object into writer. Objects of at least multipart_threshold bytes are fetched as
+    ranged parts in parallel. The parts finish out of order, so they are written at their offsets in a
+    temporary file on disk and replayed from there, in order, into writer. Smaller objects are
+    streamed straight into writer.
+    """
+    settings = settings or transfer_settings()
+    transfer_config = TransferConfig(**settings)
+    started_at = time.monotonic()
+    if size >= settings['multipart_threshold']:
+        with tempfile.TemporaryFile() as part_file:
+            download_file_from_s3(bucket, item_key, part_file, transfer_config)
+            log_transfer_rate(item_key, part_file.tell(), time.monotonic() - started_at)
+            part_file.seek(0)
+            shutil.copyfileobj(part_file, writer, DOWNLOAD_CHUNK_SIZE)
     else:
-        current_app.logger.info('Empty file: {}'.format(item_key))
+        download_file_from_s3(bucket, item_key, writer, transfer_config)
+        log_transfer_rate(item_key, size, time.monotonic() - started_at)
+
+
+def etag_md5(client, bucket_name, item):
+    """The MD5 of the content of an object when its ETag is one, which it isn't for multipart uploads and SSE-KMS."""
+    etag = item['ETag'].strip('"')
+    if '-' in etag:
+        return None
+    if client.head_object(Bucket=bucket_name, Key=item['Key']).get('ServerSideEncryption') == 'aws:kms':
         return None
+    return etag
 
 
-def get_csv_reader_from_s3(bucket, item_key):
+def download_resumable(bucket, item, writer, partial, settings=None):
+    """
+    Downloads an object as ranged GETs of multipart_chunksize bytes into a partial download, so a later
+    attempt only fetches the parts that did not complete. IfMatch pins all parts to the listed version.
+    """
+    settings = settings or transfer_settings()
+    client = bucket.meta.client
+
+    def fetch_range(start, end, write):
+        response = client.get_object(
+            Bucket=bucket.name, Key=item['Key'], Range=f'bytes={start}-{end - 1}', IfMatch=item['ETag'])
+        for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+            write(chunk)
+
+    started_at = time.monotonic()
+    partial.fetch_parts(fetch_range, settings['multipart_chunksize'], settings['max_concurrency'])
+    log_transfer_rate(item['Key'], item['Size'], time.monotonic() - started_at)
+    partial.replay(writer, etag_md5(client, bucket.name, item))
+
+
+def log_transfer_rate(item_key, size, seconds):
+    rate = size / MB / seconds if seconds > 0 else 0
+    current_app.logger.info(
+        f'Downloaded {item_key}: {size} bytes in {seconds:.2f}s ({rate:.1f} MB/s)',
+        extra={'bytes': size, 'seconds': seconds, 'bytes_per_second': size / seconds if seconds > 0 else None}
+    )
+
+
+def download_s3_object(bucket, item, writer, source, settings=None):
+    partial = partial_download(source, s3_fingerprint(item), item['Size'])
+    if partial:
+        with partial:
+            download_resumable(bucket, item, writer, partial, settings)
+    else:
+        download_object(bucket, item['Key'], writer, item['Size'], settings)
+
+
+def get_csv_reader_from_s3(bucket, item, encoding_hint=None, settings=None):
+    item_key = item['Key']
+    fingerprint = s3_fingerprint(item)
+    source = f's3://{bucket.name}/{item_key}'
     current_app.logger.info('Starting to fetch file {}'.format(item_key))
-    file_object = download_file_from_s3(bucket, item_key)
-    if item_key.endswith('.gz'):
-        try:
-            file_object = BytesIO(gzip.decompress(file_object.getvalue()))
-        except OSError as error:
-            current_app.logger.info(f'Attempted decompressing invalid gzip: {item_key}')
-            raise error
+    spool = HashingSpool(encoding_hint)
+    try:
+        with decompressing_writer(item_key, spool) as writer:
+            cached_download(source, fingerprint, lambda raw_writer: download_s3_object(
+                bucket, item, raw_writer, source, settings), writer)
+    except DecompressionException as error:
+        current_app.logger.info(f'Attempted decompressing invalid file: {item_key}')
+        raise error
     current_app.logger.info('Got file {}'.format(item_key))
-    return get_reader_from_bytes(file_object, item_key)
+    fetched_file = get_reader_from_spool(spool, item_key, fingerprint)
+    return fetched_file._replace(modified_at=item['LastModified'].replace(tzinfo=None)) if fetched_file else None
 
 
-def should_process_file(item, last_successfully_processed_at):
-    if "application/x-directory" not in item.get()[
-        "ContentType"
-    ] and item.last_modified > UTC.localize(last_successfully_processed_at):
-        return True
-    return False
+def s3_fingerprint(item):
+    return file_fingerprint('s3', item['Key'], item['Size'], item['ETag'])
 
 
-def get_latest_file_from_s3(
-    bucket_name, path, aws_creds, last_successfully_processed_at
+def should_process_file(item, modified_after, known_fingerprints=()):
+    """
+    Decides on the listing metadata of an object (Key, LastModified, Size, ETag) alone, without
+    fetching the object itself.
+    """
+    if item['Key'].endswith('/'):
+        # Directory placeholder
+        return False
+    if s3_fingerprint(item) in known_fingerprints:
+        current_app.logger.info(f'Skipping download of file {item["Key"]}: ETag {item["ETag"]} already processed.')
+        return False
+    # Objects modified exactly at the checkpoint are kept, the fingerprint check above skips the processed ones
+    if modified_after is not None and item['LastModified'] < modified_after:
+        return False
+    if item['Size'] == 0:
+        current_app.logger.info('Empty file: {}'.format(item['Key']))
+        return False
+    return True
+
+
+def list_s3_prefix(client, bucket_name, prefix, delimiter=None):
+    """Returns the objects and, with a delimiter, the sub-prefixes directly under prefix."""
+    paginator = client.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    objects = []
+    sub_prefixes = []
+    for page in paginator.paginate(**kwargs):
+        objects += page.get('Contents', [])
+        sub_prefixes += [common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])]
+    return objects, sub_prefixes
+
+
+def list_s3_objects(client, bucket_name, prefix, max_workers=1):
+    """
+    Lists every object under prefix. The first level is listed with a delimiter so the sub-prefixes
+    can be paginated concurrently. Objects are returned in key order, like a plain listing.
+    """
+    objects, sub_prefixes = list_s3_prefix(client, bucket_name, prefix, delimiter='/')
+    for sub_prefix_objects, _ in ordered_map(
+            lambda sub_prefix: list_s3_prefix(client, bucket_name, sub_prefix), sub_prefixes, max_workers):
+        objects += sub_prefix_objects
+    return sorted(objects, key=lambda item: item['Key'])
+
+
+def new_s3_objects(
+    client, bucket_name, path, last_successfully_processed_at, known_fingerprints=(), max_workers=1,
+    last_seen_modified_at=None
 ):
+    """The objects under path to download, in key order."""
     # currently, path includes "/" - Which if included in the filter would not find the correct file.
     path = path[1:] if path[0] == '/' else path
+    modified_after = last_seen_modified_at or last_successfully_processed_at
+    modified_after = UTC.localize(modified_after) if modified_after else None
+    return [
+        item for item in list_s3_objects(client, bucket_name, path, max_workers)
+        if should_process_file(item, modified_after, known_fingerprints)
+    ]
+
+
+def s3_resource(aws_creds):
     api_id, api_key = aws_creds.split(":")
     config_helper = ConfigVariableHelper(
         os.getenv("FLASK_ENV"), current_app.config.get("GOOGLE_CLOUD_PROJECT")
     )
-    s3 = boto3.resource(
+    return boto3.resource(
         "s3",
         aws_access_key_id=config_helper.get_variable(api_id),
         aws_secret_access_key=config_helper.get_variable(api_key),
     )
+
+
+def get_latest_file_from_s3(
+    bucket_name, path, aws_creds, last_successfully_processed_at, known_fingerprints=(), max_workers=1,
+    encoding_hint=None, last_seen_modified_at=None, transfer_overrides=None
+):
+    """
+    Yields the new objects under path. Objects are new when they were modified after the checkpoint
+    last_seen_modified_at (the newest LastModified of a previous successful sync), or after
+    last_successfully_processed_at when there is no checkpoint yet. transfer_overrides tune the
+    TransferConfig of the downloads (see DEFAULT_TRANSFER_SETTINGS).
+    """
+    s3 = s3_resource(aws_creds)
     bucket = s3.Bucket(bucket_name)
-    csv_readers = []
-    for item in bucket.objects.filter(Prefix=path):
-        if should_process_file(item, last_successfully_processed_at):
-            csv_readers.append(get_csv_reader_from_s3(bucket, item.key))
-    output = list(filter(None, csv_readers))
-    return output
+    settings = transfer_settings(transfer_overrides)
+    downloads = new_s3_objects(
+        s3.meta.client, bucket_name, path, last_successfully_processed_at, known_fingerprints, max_workers,
+        last_seen_modified_at)
+    for fetched_file in ordered_map(
+            lambda item: get_csv_reader_from_s3(bucket, item, encoding_hint, settings), downloads, max_workers):
+        if fetched_file:
+            yield fetched_file
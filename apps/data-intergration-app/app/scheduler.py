@@ -0,0 +1,196 @@
+import datetime
+import statistics
+import time
+from collections import namedtuple
+from rq.worker import Worker
+from app.locks import LeaseLock
+from app.models import ProcessingEntry
+
+# Size classes and the queues their jobs go to, workers should listen to all of them:
+#   flask rq worker small medium backfill default
+SMALL_QUEUE = 'small'
+MEDIUM_QUEUE = 'medium'
+BACKFILL_QUEUE = 'backfill'
+# Jobs queued before the size classes existed
+DEFAULT_QUEUE = 'default'
+SYNC_QUEUES = [SMALL_QUEUE, MEDIUM_QUEUE, BACKFILL_QUEUE, DEFAULT_QUEUE]
+# Share of dequeues per queue when all of them have jobs waiting
+QUEUE_WEIGHTS = {SMALL_QUEUE: 6, MEDIUM_QUEUE: 3, BACKFILL_QUEUE: 1, DEFAULT_QUEUE: 1}
+# Backfill jobs running at the same time across all workers, the other workers stay free for smaller syncs
+MAX_BACKFILL_JOBS = 2
+BACKFILL_SLOT_KEY = 'backfill-slot'
+# How often a worker that only listens to the backfill queue tries to get a slot
+BACKFILL_SLOT_POLL_SECONDS = 30
+
+# Average processing time of a sync that puts a config in a size class
+SMALL_MAX_SECONDS = 5 * 60
+MEDIUM_MAX_SECONDS = 60 * 60
+COST_HISTORY = datetime.timedelta(days=14)
+
+# Job timeouts are TIMEOUT_MARGIN times the longest recent sync, within these bounds
+TIMEOUT_MARGIN = 4
+MIN_TIMEOUT = 30 * 60
+MAX_TIMEOUT = 12 * 60 * 60
+
+# Configs are polled every MIN_POLL_INTERVAL while files arrive, the interval doubles after each poll
+# without new files up to MAX_POLL_INTERVAL
+MIN_POLL_INTERVAL = 10 * 60
+MAX_POLL_INTERVAL = 24 * 60 * 60
+POLL_BACKOFF = 2
+ARRIVAL_HISTORY = datetime.timedelta(days=30)
+
+SyncCost = namedtuple('SyncCost', ['syncs', 'avg_seconds', 'max_seconds', 'avg_bytes', 'avg_rows'])
+SyncJob = namedtuple('SyncJob', ['config', 'queue', 'timeout', 'cost'])
+
+
+def estimate_costs(config_ids, now=None):
+    """SyncCost per config id from the ProcessingEntry history, configs without history are left out."""
+    if not config_ids:
+        return {}
+    since = (now or datetime.datetime.now()) - COST_HISTORY
+    return {
+        row.config_id: SyncCost(
+            row.syncs, float(row.avg_seconds or 0), float(row.max_seconds or 0),
+            float(row.avg_bytes or 0), float(row.avg_rows or 0))
+        for row in ProcessingEntry.get_sync_costs(config_ids, since)
+    }
+
+
+def size_class(cost):
+    # Configs without history could be anything, they are not trusted with the small queue
+    if cost is None:
+        return MEDIUM_QUEUE
+    if cost.avg_seconds < SMALL_MAX_SECONDS:
+        return SMALL_QUEUE
+    if cost.avg_seconds < MEDIUM_MAX_SECONDS:
+        return MEDIUM_QUEUE
+    return BACKFILL_QUEUE
+
+
+def job_timeout(cost):
+    if cost is None:
+        return MAX_TIMEOUT
+    return int(min(MAX_TIMEOUT, max(MIN_TIMEOUT, TIMEOUT_MARGIN * cost.max_seconds)))
+
+
+def plan_sync_jobs(configs, now=None):
+    """
+    SyncJobs for configs: the size class queue and timeout of each config from its cost estimate.
+    Cheaper jobs go first, so within a queue short syncs don't wait behind long ones.
+    """
+    costs = estimate_costs([config.id for config in configs], now)
+    jobs = [
+        SyncJob(config, size_class(costs.get(config.id)), job_timeout(costs.get(config.id)), costs.get(config.id))
+        for config in configs
+    ]
+    return sorted(jobs, key=lambda job: job.cost.avg_seconds if job.cost else MEDIUM_MAX_SECONDS)
+
+
+def weighted_queue_order(queue_names, credits, busy, weights=QUEUE_WEIGHTS):
+    """
+    Smooth weighted round robin over the queues with jobs waiting: each of them earns its weight in
+    credits, the one with the most credits is tried first and pays the weights of all of them. Busy
+    queues get dequeues in proportion to their weights and idle queues don't build up credits.
+    """
+    busy = [name for name in queue_names if name in busy]
+    if not busy:
+        return list(queue_names)
+    for name in busy:
+        credits[name] = credits.get(name, 0) + weights.get(name, 1)
+    first = max(busy, key=lambda name: credits[name])
+    credits[first] -= sum(weights.get(name, 1) for name in busy)
+    return [first] + [name for name in queue_names if name != first]
+
+
+class WeightedFairWorker(Worker):
+    """
+    RQ worker that dequeues from its queues by QUEUE_WEIGHTS instead of in strict priority order.
+    Weights alone would let long backfill jobs take every worker over time, so a worker only listens
+    to the backfill queue while it holds one of the MAX_BACKFILL_JOBS backfill slot leases. The slot is
+    kept while its backfill job runs and given back as soon as the worker gets any other job.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._credits = {}
+        self._backfill_slot = None
+
+    def acquire_backfill_slot(self):
+        if self._backfill_slot is None:
+            for slot in range(MAX_BACKFILL_JOBS):
+                lease = LeaseLock(self.connection, f'{BACKFILL_SLOT_KEY}-{slot}')
+                if lease.acquire():
+                    self._backfill_slot = lease
+                    break
+        return self._backfill_slot is not None
+
+    def release_backfill_slot(self):
+        if self._backfill_slot is not None:
+            self._backfill_slot.release()
+            self._backfill_slot = None
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        queues = {queue.name: queue for queue in self.queues}
+        if BACKFILL_QUEUE in queues and not self.acquire_backfill_slot():
+            if len(queues) == 1:
+                while not self.acquire_backfill_slot():
+                    self.heartbeat()
+                    time.sleep(BACKFILL_SLOT_POLL_SECONDS)
+            else:
+                del queues[BACKFILL_QUEUE]
+        busy = {name for name, queue in queues.items() if queue.count}
+        self._ordered_queues = [queues[name] for name in weighted_queue_order(list(queues), self._credits, busy)]
+        result = super().dequeue_job_and_maintain_ttl(timeout)
+        if result is None or result[1].name != BACKFILL_QUEUE:
+            self.release_backfill_slot()
+        return result
+
+    def execute_job(self, job, queue):
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            if queue.name == BACKFILL_QUEUE:
+                self.release_backfill_slot()
+
+
+def expected_arrival(arrival_times):
+    """
+    When the next files are expected: the median time between the past arrivals after the last one,
+    or None without enough history. Arrivals closer together than MIN_POLL_INTERVAL count as one.
+    """
+    arrivals = []
+    for arrived_at in arrival_times:
+        if not arrivals or (arrived_at - arrivals[-1]).total_seconds() >= MIN_POLL_INTERVAL:
+            arrivals.append(arrived_at)
+    if len(arrivals) < 2:
+        return None
+    return arrivals[-1] + statistics.median(later - earlier for earlier, later in zip(arrivals, arrivals[1:]))
+
+
+def schedule_next_poll(config, found_files, arrival_times, now=None):
+    """
+    Sets the poll_interval_seconds and next_sync_at of config after a sync or probe. Found files snap
+    the interval back to MIN_POLL_INTERVAL, otherwise it backs off exponentially. A backed off poll is
+    moved up to the expected arrival of the next files, polling starts over from there.
+    """
+    now = now or datetime.datetime.now()
+    if found_files:
+        config.poll_interval_seconds = MIN_POLL_INTERVAL
+        config.next_sync_at = now + datetime.timedelta(seconds=MIN_POLL_INTERVAL)
+        return
+    interval = min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, POLL_BACKOFF * (config.poll_interval_seconds or 0)))
+    next_sync_at = now + datetime.timedelta(seconds=interval)
+    arrival = expected_arrival(arrival_times)
+    if arrival is not None and now < arrival < next_sync_at:
+        interval = MIN_POLL_INTERVAL
+        next_sync_at = arrival
+    config.poll_interval_seconds = interval
+    config.next_sync_at = next_sync_at
+
+
+def schedule_next_polls(configs, found_files, now=None):
+    """schedule_next_poll for configs, found_files by config id, with one query for the arrival history."""
+    now = now or datetime.datetime.now()
+    arrivals = ProcessingEntry.get_arrival_times([config.id for config in configs], now - ARRIVAL_HISTORY)
+    for config in configs:
+        schedule_next_poll(config, found_files[config.id], arrivals[config.id], now)
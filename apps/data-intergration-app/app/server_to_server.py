@@ -1,5 +1,7 @@
 import requests
+from urllib3.util.retry import Retry
 from flask import current_app
+from app.helpers import ordered_map
 
 
 class ServerToServerSenderException(Exception):
@@ -8,9 +10,12 @@ class ServerToServerSenderException(Exception):
 
 class ServerToServerSender:
     API_URL = '[FILL ME IN S2S ENDPOINT]'
+    # Number of requests in flight at the same time
+    CONCURRENCY = 10
 
-    def __init__(self, data):
+    def __init__(self, data, concurrency=None):
         self.data = data
+        self.concurrency = concurrency or self.CONCURRENCY
 
     def send(self):
         current_app.logger.info('Sending conversion events to S2S endpoint')
@@ -18,24 +23,29 @@ class ServerToServerSender:
 
         successes = 0
         failures = 0
-        for row in self.data:
-            response = session.get(self.API_URL, params=self.to_s2s_event(row))
-            if response is not None and response.status_code == requests.codes.ok:
+        for sent in ordered_map(lambda row: self.send_event(session, row), self.data, self.concurrency):
+            if sent:
                 successes += 1
             else:
-                if response is None:
-                    current_app.logger.error(
-                        'Failed to send S2S event! No response')
-                else:
-                    current_app.logger.error(
-                        'Failed to send S2S event! Status: {}'.format(
-                            response.status_code))
                 failures += 1
 
         current_app.logger.info(
-            '{}/{} S2S events sent successfully'.format(successes, len(self.data)))
+            '{}/{} S2S events sent successfully'.format(successes, successes + failures))
         return {'successes': successes, 'failures': failures}
 
+    def send_event(self, session, row):
+        response = session.get(self.API_URL, params=self.to_s2s_event(row))
+        if response is not None and response.status_code == requests.codes.ok:
+            return True
+        if response is None:
+            current_app.logger.error(
+                'Failed to send S2S event! No response')
+        else:
+            current_app.logger.error(
+                'Failed to send S2S event! Status: {}'.format(
+                    response.status_code))
+        return False
+
     def to_s2s_event(self, row):
         return {
             'type': 's2s',
@@ -49,7 +59,11 @@ class ServerToServerSender:
         }
 
     def retrying_http_session(self):
+        # The connection pool is as large as the in-flight window so every worker keeps its connection alive
         session = requests.Session()
-        session.mount('http://', requests.adapters.HTTPAdapter(max_retries=3))
-        session.mount('https://', requests.adapters.HTTPAdapter(max_retries=3))
+        retries = Retry(total=3, backoff_factor=1)
+        adapter = requests.adapters.HTTPAdapter(
+            max_retries=retries, pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
         return session
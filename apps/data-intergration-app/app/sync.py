@@ -5,13 +5,14 @@ from app.models import ProcessingEntry, db
 from app.ftp import get_files_in_sftp_url, get_files_in_ftp_url
 from app.http import get_file_from_url
 from app.s3 import get_latest_file_from_s3
+from app.scheduler import schedule_next_polls
 from app.converse import ConverseCampaignSender, ConverseAdSender
 from app.custom_conversions import CustomConversionSender
 from app.server_to_server import ServerToServerSender
 from app.multiplatform_server_to_server import MultiplatformServerToServerSender
 from app.aggregate_multiplatform_server_to_server import AggregateMultiplatformServerToServerSender
+from app.liquid_templates import render
 from flask import current_app
-from liquid import Environment
 
 
 class SyncException(Exception):
@@ -19,22 +20,19 @@ class SyncException(Exception):
 
 
 class SyncProcessor:
-    def __init__(self, config):
+    def __init__(self, config, lease=None):
         self.config = config
-        self._readers = []
-
-    def running(self):
-        if self.config.last_processing_started_at is None:
-            return False
-        elif self.config.last_processed_at is None:
-            return True
-        elif self.config.last_processing_started_at > self.config.last_processed_at:
-            return True
-        else:
-            return False
+        self.lease = lease
+        self._readers = iter([])
+        self._newest_modified_at = None
+        self._http_validators = None
+        self._processed_md5s = set()
+        self._found_files = False
 
     def get_readers(self):
         parsed_url = urlparse(self.config.file_url)
+        # Loaded once per sync, files are deduplicated against these without a query per file
+        self._processed_md5s, known_fingerprints = ProcessingEntry.get_processed_md5s_and_fingerprints(self.config.id)
         if parsed_url.scheme == 'sftp':
             return get_files_in_sftp_url(
                 parsed_url.hostname,
@@ -43,7 +41,10 @@ class SyncProcessor:
                 self.config.connection_path,
                 self.config.connection_port,
                 self.config.last_successfully_processed_at,
-                self.config.check_subdirs)
+                self.config.check_subdirs,
+                known_fingerprints,
+                self.config.download_concurrency or 1,
+                self.config.last_detected_encoding)
         elif 'ftp' in parsed_url.scheme == 'ftp':
             return get_files_in_ftp_url(
                 parsed_url.hostname,
@@ -51,17 +52,25 @@ class SyncProcessor:
                 self.config.connection_password,
                 self.config.connection_path,
                 self.config.connection_port,
-                self.config.last_successfully_processed_at)
+                self.config.last_successfully_processed_at,
+                known_fingerprints,
+                self.config.download_concurrency or 1,
+                self.config.last_detected_encoding)
         elif 'http' in parsed_url.scheme:
-            env = Environment()
-            env.add_filter("fromtimestamp", datetime.fromtimestamp)
-            resolved_url = env.from_string(self.config.file_url).render()
-            return [get_file_from_url(resolved_url)]
+            resolved_url = render(self.config.file_url)
+            fetched_file, self._http_validators = get_file_from_url(
+                resolved_url, self.config.last_detected_encoding, self.config.http_validators)
+            return list(filter(None, [fetched_file]))
         elif 's3' in parsed_url.scheme:
             return get_latest_file_from_s3(
                 parsed_url.netloc, parsed_url.path,
                 self.config.connection_username,
-                self.config.last_successfully_processed_at
+                self.config.last_successfully_processed_at,
+                known_fingerprints,
+                self.config.download_concurrency or 1,
+                self.config.last_detected_encoding,
+                self.config.last_seen_modified_at,
+                self.config.s3_transfer_config
             )
         else:
             raise SyncException(
@@ -76,14 +85,28 @@ class SyncProcessor:
             self.handle_readers()
             self.config.last_successfully_processed_at = datetime.now()
             self.config.last_processed_at = datetime.now()
+            if self._newest_modified_at:
+                self.config.last_seen_modified_at = self._newest_modified_at
+            if self._http_validators:
+                self.config.http_validators = self._http_validators
+            schedule_next_polls([self.config], {self.config.id: self._found_files})
             db.session.commit()
         except Exception as e:
             current_app.logger.exception(
                 f'Fatal error in sync for {self.config}',
                 extra={'error': e}
             )
-            self.config.last_processed_at = datetime.now()
-            db.session.commit()
+            # The bookkeeping must not mask e, e.g. when e left the session unusable
+            try:
+                self.config.last_processed_at = datetime.now()
+                schedule_next_polls([self.config], {self.config.id: self._found_files})
+                db.session.commit()
+            except Exception as bookkeeping_error:
+                db.session.rollback()
+                current_app.logger.exception(
+                    f'Failed to record the failed sync for {self.config}',
+                    extra={'error': bookkeeping_error}
+                )
             raise e
 
     def handle_custom_conversion_import(self, parser):
@@ -165,51 +188,79 @@ class SyncProcessor:
         processing_entry.output_rows_accepted = result.get('successes')
         processing_entry.finished_at = datetime.now()
 
-    def validate_success(self, succeeded):
-        if len(self._readers) != succeeded:
+    def validate_success(self, total, succeeded):
+        if total != succeeded:
             raise SyncException('Not all files were processed successfully. {}/{} failed.'.format(
-                len(self._readers) - succeeded, len(self._readers)))
+                total - succeeded, total))
+
+    def track_modified_at(self, modified_at):
+        if modified_at and (self._newest_modified_at is None or modified_at > self._newest_modified_at):
+            self._newest_modified_at = modified_at
+
+    def handle_fetched_file(self, fetched_file):
+        reader, md5, filename, fingerprint, encoding, modified_at, size = fetched_file
+        if self.lease is not None and self.lease.lost:
+            # Another worker may be syncing the config by now
+            raise SyncException(f'Lost the sync lease of config {self.config.id}')
+        self.track_modified_at(modified_at)
+        if md5 in self._processed_md5s:
+            current_app.logger.info(
+                '{} - {} was already processed, skipping...'.format(filename, md5))
+            return True
+
+        processing_entry = ProcessingEntry(
+            config_id=self.config.id,
+            status='started',
+            file_url=filename,
+            file_md5=md5,
+            file_fingerprint=fingerprint,
+            file_size=size,
+            sync_started_at=self.config.last_processing_started_at,
+            started_at=datetime.now()
+        )
+        db.session.add(processing_entry)
+        self._found_files = True
+        # The started marker is committed before anything is sent, so a crashed sync never sends a file
+        # twice. The same commit writes the status of the previous file, the status of the last file is
+        # committed with the config at the end of the sync.
+        db.session.commit()
+        self._processed_md5s.add(md5)
+
+        try:
+            parser_class = self.config.get_parser_class()
+            parser = parser_class(reader)
+            self.handle_parser(processing_entry, parser, filename)
+            # The next files of the config are tried with this encoding first
+            self.config.last_detected_encoding = encoding
+            return True
+        except Exception as e:
+            processing_entry.status = 'failed'
+            processing_entry.finished_at = datetime.now()
+            current_app.logger.exception(
+                f'Processing failed for file {filename}',
+                extra={'error': e}
+            )
+            return False
 
     def handle_readers(self):
-        if len(self._readers) == 0:
+        # Files are fetched lazily, so each one is downloaded, parsed and sent before the next one is
+        # fetched. The config and the entries stay loaded across the commit per file instead of being
+        # reloaded after each one, nothing else writes them during the sync.
+        total = 0
+        succeeded = 0
+        session = db.session()
+        expire_on_commit = session.expire_on_commit
+        session.expire_on_commit = False
+        try:
+            for fetched_file in self._readers:
+                total += 1
+                if self.handle_fetched_file(fetched_file):
+                    succeeded += 1
+        finally:
+            session.expire_on_commit = expire_on_commit
+
+        if total == 0:
             current_app.logger.info(
                 'No files to sync for config {} - {}'.format(
                     self.config.id, self.config.customer))
-        new_md5s = [x[1] for x in self._readers]
-        old_processing_entries = ProcessingEntry.get_old_processing_entries_by_config_and_md5(
-            self.config.id, new_md5s)
-        handled_md5s = [entry.file_md5 for entry in old_processing_entries]
-        succeeded = 0
-        for reader, md5, filename in self._readers:
-            if md5 in handled_md5s:
-                current_app.logger.info(
-                    '{} - {} was already processed, skipping...'.format(filename, md5))
-                succeeded += 1
-                continue
-            else:
-                processing_entry = ProcessingEntry(
-                    config_id=self.config.id,
-                    status='started',
-                    file_url=filename,
-                    file_md5=md5,
-                    started_at=datetime.now()
-                )
-                db.session.add(processing_entry)
-                db.session.commit()
-
-                try:
-                    parser_class = self.config.get_parser_class()
-                    parser = parser_class(reader)
-                    self.handle_parser(processing_entry, parser, filename)
-                    succeeded += 1
-                except Exception as e:
-                    processing_entry.status = 'failed'
-                    processing_entry.finished_at = datetime.now()
-                    current_app.logger.exception(
-                        f'Processing failed for file {filename}',
-                        extra={'error': e}
-                    )
-                finally:
-                    db.session.commit()
-
-        self.validate_success(succeeded)
+        self.validate_success(total, succeeded)
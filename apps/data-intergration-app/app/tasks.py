@@ -1,20 +1,127 @@
+import hashlib
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
 from app.sync import SyncProcessor
-from app.models import db
+from app.models import ProcessingConfig, db
+from app.probe import probe_configs
+from app.scheduler import plan_sync_jobs, schedule_next_polls, SMALL_QUEUE
+from app.locks import LeaseLock
 from app.helpers import CURRENT_PROCESSING_CONFIG
 from flask import current_app
 from flask_rq2 import RQ
 
 rq = RQ()
 
+# Probes only list the sources of a host
+PROBE_TIMEOUT = 10 * 60
+PENDING_STATUSES = [JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED]
+
+
+def sync_job_id(config_id):
+    # Deterministic, so a config has at most one sync job
+    return f'sync-config-{config_id}'
+
+
+def probe_job_id(config_ids):
+    # Deterministic, so the configs of a probe group are probed by at most one job at a time
+    key = ','.join(str(config_id) for config_id in sorted(config_ids))
+    return f'probe-configs-{hashlib.sha1(key.encode()).hexdigest()}'
+
+
+def job_pending(job_id):
+    try:
+        job = Job.fetch(job_id, connection=rq.connection)
+    except NoSuchJobError:
+        return False
+    return job.get_status() in PENDING_STATUSES
+
+
+def sync_job_pending(config_id):
+    return job_pending(sync_job_id(config_id))
+
+
+def delete_finished_job(job_id):
+    """
+    RQ keeps a finished or failed job until its result_ttl expires. Queuing a job with the same id
+    rewrites the fields of that key but keeps its expiry, so the queued job could expire before a
+    worker gets to it. The old job is deleted before its id is used again.
+    """
+    try:
+        job = Job.fetch(job_id, connection=rq.connection)
+    except NoSuchJobError:
+        return
+    if job.get_status() not in PENDING_STATUSES:
+        job.delete()
+
+
+def queue_sync_jobs(configs):
+    for job in plan_sync_jobs(configs):
+        delete_finished_job(sync_job_id(job.config.id))
+        sync_config.queue(
+            job.config.id, job.config.version, queue=job.queue, timeout=job.timeout, job_id=sync_job_id(job.config.id))
+
+
+def queue_probe_job(configs):
+    config_ids = [config.id for config in configs]
+    job_id = probe_job_id(config_ids)
+    if job_pending(job_id):
+        current_app.logger.info(f'Probe of configs {config_ids} is already queued or running')
+        return
+    delete_finished_job(job_id)
+    probe_and_queue_syncs.queue(config_ids, queue=SMALL_QUEUE, timeout=PROBE_TIMEOUT, job_id=job_id)
+
+
+def load_config(config_id, version=None):
+    """
+    ProcessingConfig config_id, or None if it was deleted. RQ workers run every job in a forked child
+    process, so the config is loaded by id for each job. A config that changed after the job was
+    queued is synced with its current definition.
+    """
+    config = ProcessingConfig.query.get(config_id)
+    if config is not None and version is not None and config.version != version:
+        current_app.logger.info(
+            f'Config {config_id} changed from version {version} to {config.version} since the sync was queued')
+    return config
+
+
+def sync_lease(config_id):
+    return LeaseLock(rq.connection, f'sync-lease-config-{config_id}')
+
 
 @rq.job
-def sync_config(processing_config):
+def sync_config(config_id, version=None):
+    # Jobs queued before configs were enqueued by id carry the pickled config
+    if isinstance(config_id, ProcessingConfig):
+        config_id = config_id.id
+    processing_config = load_config(config_id, version)
+    if processing_config is None:
+        current_app.logger.info(f'Skipping sync for config {config_id}: config no longer exists.')
+        return
     current_app.config[CURRENT_PROCESSING_CONFIG] = processing_config
-    current_app.logger.info('Starting to sync {}'.format(processing_config.customer))
-    db.session.add(processing_config)
-    sync_processor = SyncProcessor(processing_config)
-    if sync_processor.running():
+    lease = sync_lease(config_id)
+    if not lease.acquire():
         current_app.logger.info(f'Skipping sync for: {processing_config.customer}. Sync is already in progress.')
-    else:
-        sync_processor.run_sync()
-    current_app.logger.info('Sync for {} completed'.format(processing_config.customer))
+        return
+    try:
+        current_app.logger.info('Starting to sync {}'.format(processing_config.customer))
+        SyncProcessor(processing_config, lease).run_sync()
+        current_app.logger.info('Sync for {} completed'.format(processing_config.customer))
+    finally:
+        lease.release()
+
+
+@rq.job
+def probe_and_queue_syncs(config_ids):
+    """Probes the configs of a probe group and queues syncs of those with new files."""
+    configs = ProcessingConfig.query.filter(ProcessingConfig.id.in_(config_ids)).all()
+    # A forced sync may have been queued since the probe was
+    configs = [config for config in configs if not sync_job_pending(config.id)]
+    if not configs:
+        return
+    changes = probe_configs(configs)
+    # Configs without new files are not synced, the probe backs off their polling instead
+    schedule_next_polls([config for config in configs if not changes[config.id]], changes)
+    db.session.commit()
+    configs = [config for config in configs if changes[config.id]]
+    current_app.logger.info(f'{len(configs)} of configs {config_ids} have new files')
+    queue_sync_jobs(configs)
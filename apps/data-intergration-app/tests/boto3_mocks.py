@@ -2,39 +2,60 @@ from datetime import datetime
 from pytz import UTC
 
 
-class BotoObject:
-    def __init__(self):
-        self.key = "tc-rover-s3-test/rover example s2s.csv"
-        self.last_modified = UTC.localize(datetime.utcnow())
-        self.ContentType = ""
-
-    def get(self):
-        if len(self.ContentType) == 0:
-            return {"ContentType": "not_a_directory"}
-        else:
-            return {"ContentType": "application/x-directory"}
-
-    def set_content_type(self, content_type):
-        self.ContentType = content_type
-
-
-class BotoObjects:
-    def __init__(self):
-        pass
-
-    def filter(self, Prefix):
-        return [BotoObject()]
+def boto_object(key="tc-rover-s3-test/rover example s2s.csv", size=128):
+    """An object as returned in the Contents of a list_objects_v2 page."""
+    return {
+        'Key': key,
+        'LastModified': UTC.localize(datetime.utcnow()),
+        'Size': size,
+        'ETag': '"d41d8cd98f00b204e9800998ecf8427e"',
+    }
+
+
+class BotoPaginatorMock:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        contents = []
+        common_prefixes = []
+        for item in self.objects:
+            if not item['Key'].startswith(Prefix):
+                continue
+            rest = item['Key'][len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if {'Prefix': common_prefix} not in common_prefixes:
+                    common_prefixes.append({'Prefix': common_prefix})
+            else:
+                contents.append(item)
+        return [{'Contents': contents, 'CommonPrefixes': common_prefixes}]
+
+
+class BotoClientMock:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return BotoPaginatorMock(self.objects)
+
+
+class BotoMetaMock:
+    def __init__(self, objects):
+        self.client = BotoClientMock(objects)
 
 
 class BotoBucketMock:
-    def __init__(self):
-        self.objects = BotoObjects()
+    def __init__(self, name):
+        self.name = name
 
 
 class BotoResourceMock:
     def __init__(self, protocol, aws_access_key_id, aws_secret_access_key):
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.meta = BotoMetaMock([boto_object()])
 
     def Bucket(self, bucket_name):
-        return BotoBucketMock()
+        return BotoBucketMock(bucket_name)
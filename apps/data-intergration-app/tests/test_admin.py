@@ -0,0 +1,16 @@
+import pytest
+from app.admin import admin, ProcessingConfigAdminView, LiquidException
+
+
+@pytest.fixture
+def config_view():
+    return next(view for view in admin._views if isinstance(view, ProcessingConfigAdminView))
+
+
+def test_validate_liquid_dict(config_view):
+    config_view.validate_liquid_dict({'column_name': 'Users', 'template': '{{ value | times: 2 }}'})
+
+
+def test_validate_liquid_dict_rejects_invalid_template(config_view):
+    with pytest.raises(LiquidException):
+        config_view.validate_liquid_dict({'column_name': 'Users', 'template': '{{ value | times: 2 '})
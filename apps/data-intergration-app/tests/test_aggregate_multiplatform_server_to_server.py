@@ -4,6 +4,7 @@ from app.aggregate_multiplatform_server_to_server import AggregateMultiplatformS
 from app.helpers import get_csv_reader
 from app.parsers.example_aggregate_multiplatform_server_to_server import ExampleAggregateS2SParser
 import os
+import json
 
 
 event_with_all_fields = {
@@ -46,9 +47,10 @@ def test_failures():
 
     assert len(responses.calls) == 0
     result = s2s_sender.send()
-    assert len(responses.calls) == 4  # no retries,
-    assert len(s2s_data) == 4  # only 4 separate requests,
-    assert result['failures'] == 4  # each only
+    # no retries, the rejected batch of 4 is split into 2 batches of 2 and then into single events
+    assert len(responses.calls) == 7
+    assert len(s2s_data) == 4
+    assert result['failures'] == 4
     assert result['successes'] == 0
 
 
@@ -76,10 +78,55 @@ def test_successfull_http_calls():
     s2s_sender = AggregateMultiplatformServerToServerSender(s2s_data, "supersecret")
     result = s2s_sender.send()
 
-    assert len(responses.calls) == 4
+    assert len(responses.calls) == 1
+    assert len(json.loads(responses.calls[0].request.body)['events']) == 4
     assert result['successes'] == 4
 
 
+@responses.activate
+def test_batches_are_limited_by_event_count_and_size():
+    responses.add(
+        responses.POST,
+        '[FILL ME IN S2S ENDPOINT]',
+        status=200,
+        json={})
+
+    events = [{**event_with_all_fields, 'ad_unit_id': str(i)} for i in range(25)]
+    s2s_sender = AggregateMultiplatformServerToServerSender(events, 'supersecret')
+    s2s_sender.MAX_BATCH_EVENTS = 10
+    result = s2s_sender.send()
+    assert [len(json.loads(call.request.body)['events']) for call in responses.calls] == [10, 10, 5]
+    assert result == {'successes': 25, 'failures': 0}
+
+    responses.calls.reset()
+    s2s_sender.MAX_BATCH_BYTES = len(json.dumps(events[0])) * 3
+    s2s_sender.send()
+    assert max(len(json.loads(call.request.body)['events']) for call in responses.calls) <= 3
+
+
+@responses.activate
+def test_rejected_batch_only_fails_the_bad_event():
+    def request_callback(request):
+        events = json.loads(request.body)['events']
+        if any(event['ad_unit_id'] == '3' for event in events):
+            return (400, {}, '{"message": "Invalid ad unit"}')
+        return (200, {}, '{}')
+
+    responses.add_callback(
+        responses.POST,
+        '[FILL ME IN S2S ENDPOINT]',
+        callback=request_callback,
+        content_type='application/json')
+
+    events = ({**event_with_all_fields, 'ad_unit_id': str(i)} for i in range(5))
+    s2s_sender = AggregateMultiplatformServerToServerSender(events, 'supersecret')
+    result = s2s_sender.send()
+
+    assert result == {'successes': 4, 'failures': 1}
+    accepted = [json.loads(call.request.body)['events'] for call in responses.calls if call.response.status_code == 200]
+    assert sorted(event['ad_unit_id'] for events in accepted for event in events) == ['0', '1', '2', '4']
+
+
 def test_to_multiplatform_s2s_event_exception_handling():
     s2s_sender = AggregateMultiplatformServerToServerSender([], 'supersecret')
 
@@ -0,0 +1,51 @@
+import bz2
+import gzip
+import io
+import zipfile
+import pytest
+import zstandard
+from app.compression import decompressing_writer, DecompressionException
+
+data = b'foo,bar,baz\n' + b'1,2,3\n' * 1000
+
+
+def write_in_chunks(filename, content, passthrough_uncompressed=False, chunk_size=100):
+    target = io.BytesIO()
+    with decompressing_writer(filename, target, passthrough_uncompressed) as writer:
+        for i in range(0, len(content), chunk_size):
+            writer.write(content[i:i + chunk_size])
+    return target.getvalue()
+
+
+def zip_bytes(content):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('conversions.csv', content)
+    return archive.getvalue()
+
+
+@pytest.mark.parametrize('filename,compressed', [
+    ('conversions.csv', data),
+    ('conversions.csv.gz', gzip.compress(data)),
+    ('conversions.csv.gz', gzip.compress(data[:100]) + gzip.compress(data[100:])),
+    ('conversions.csv.bz2', bz2.compress(data)),
+    ('conversions.csv.zst', zstandard.ZstdCompressor().compress(data)),
+    ('conversions.csv.zip', zip_bytes(data)),
+])
+def test_decompressing_writer(filename, compressed):
+    assert write_in_chunks(filename, compressed) == data
+
+
+def test_decompressing_writer_invalid_data():
+    with pytest.raises(DecompressionException):
+        write_in_chunks('conversions.csv.gz', data)
+
+
+def test_decompressing_writer_truncated_data():
+    with pytest.raises(DecompressionException):
+        write_in_chunks('conversions.csv.gz', gzip.compress(data)[:-20])
+
+
+def test_decompressing_writer_passes_uncompressed_data_through():
+    assert write_in_chunks('conversions.csv.gz', data, passthrough_uncompressed=True) == data
+    assert write_in_chunks('conversions.csv.gz', gzip.compress(data), passthrough_uncompressed=True) == data
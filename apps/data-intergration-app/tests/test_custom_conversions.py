@@ -4,8 +4,8 @@ import os
 from app.custom_conversions import CustomConversionSender, CustomConversionSenderException
 from app.helpers import get_csv_reader
 from app.parsers.visualiq import VisualIqParser
-from requests.exceptions import HTTPError
 from decimal import Decimal
+import simplejson as json
 
 
 @pytest.fixture(autouse=True)
@@ -25,9 +25,12 @@ def test_generating_payload():
 
     custom_conversion_sender = CustomConversionSender(
         custom_conversion_data, 'supersecret')
-    payloads = custom_conversion_sender._generate_api_payloads()
+    payloads = list(custom_conversion_sender._generate_api_payloads())
     assert len(payloads) == 1
 
+    row_count, body = payloads[0]
+    assert row_count == 3
+    payloads = [json.loads(body, use_decimal=True)]
     assert payloads[0]['ignore_invalid_ad_ids'] is True
     assert payloads[0]['data'][0]['date'] == '2019-01-02'
     assert payloads[0]['data'][0]['ad_id'] == '6112314979164'
@@ -52,7 +55,7 @@ def test_raises_error_when_api_token_is_missing():
 
 
 @responses.activate
-def test_raises_an_error_when_http_call_not_successful():
+def test_counts_failures_when_http_call_not_successful():
     responses.add(
         responses.POST,
         '[FILL ME IN S2S ENDPOINT]',
@@ -67,8 +70,8 @@ def test_raises_an_error_when_http_call_not_successful():
     os.environ['supersecret'] = 'foo'
     custom_conversion_sender = CustomConversionSender(
         custom_conversion_data, 'supersecret')
-    with pytest.raises(HTTPError):
-        custom_conversion_sender.send()
+    result = custom_conversion_sender.send()
+    assert result == {'successes': 0, 'failures': 3}
 
 
 @responses.activate
@@ -136,30 +139,60 @@ def test_successful_sending_wilh_multiple_batches():
     assert result['successes'] == 30000
 
 
-def test_chunks():
-    data = range(10)
-    chunks = list(CustomConversionSender.chunks(data, 5))
-    assert len(chunks) == 5
-    assert len(chunks[0]) == 2
+def test_payloads_are_contiguous_and_size_bounded():
+    rows = [{'ad_id': str(i), 'type': 'purchase', 'date': '2019-01-02', 'actions': i} for i in range(25)]
+    custom_conversions_sender = CustomConversionSender(rows, 'foo')
+    custom_conversions_sender.MAX_ROWS_PER_PAYLOAD = 10
+    payloads = list(custom_conversions_sender._generate_api_payloads())
+    assert [row_count for row_count, _ in payloads] == [10, 10, 5]
+    sent_rows = [row for _, body in payloads for row in json.loads(body)['data']]
+    assert sent_rows == rows
+
+    custom_conversions_sender.MAX_PAYLOAD_BYTES = 200
+    payloads = list(custom_conversions_sender._generate_api_payloads())
+    assert all(len(body) <= 200 for _, body in payloads)
+    assert sum(row_count for row_count, _ in payloads) == 25
 
-    data = range(10)
-    chunks = list(CustomConversionSender.chunks(data, 3))
-    assert len(chunks) == 3
-    num_of_items_in_total = 0
-    for chunk in chunks:
-        num_of_items_in_total += len(list(chunk))
-    assert num_of_items_in_total == 10
 
+@responses.activate
+def test_partial_failures_are_counted_per_payload():
+    def request_callback(request):
+        rows = json.loads(request.body)['data']
+        return (200, {}, json.dumps({'count': len(rows) - 1}))
+
+    responses.add_callback(
+        responses.POST, '[FILL ME IN S2S ENDPOINT]',
+        callback=request_callback,
+        content_type='application/json',
+    )
+
+    rows = [{'ad_id': str(i), 'type': 'purchase', 'date': '2019-01-02', 'actions': i} for i in range(25)]
+    os.environ['supersecret'] = 'foo'
+    custom_conversions_sender = CustomConversionSender(rows, 'supersecret')
+    custom_conversions_sender.MAX_ROWS_PER_PAYLOAD = 10
+    result = custom_conversions_sender.send()
+    assert len(responses.calls) == 3
+    assert result == {'successes': 22, 'failures': 3}
 
-def test_get_chunk_size():
-    custom_conversions_sender = CustomConversionSender(range(10000), 'foo')
-    chunk_size = custom_conversions_sender.get_chunk_size()
-    assert chunk_size == 1
 
-    custom_conversions_sender = CustomConversionSender(range(20000), 'foo')
-    chunk_size = custom_conversions_sender.get_chunk_size()
-    assert chunk_size == 2
+@responses.activate
+def test_failed_payload_does_not_stop_the_others():
+    def request_callback(request):
+        rows = json.loads(request.body)['data']
+        if rows[0]['ad_id'] == '10':
+            return (500, {}, '')
+        return (200, {}, json.dumps({'count': len(rows)}))
+
+    responses.add_callback(
+        responses.POST, '[FILL ME IN S2S ENDPOINT]',
+        callback=request_callback,
+        content_type='application/json',
+    )
 
-    custom_conversions_sender = CustomConversionSender(range(20010), 'foo')
-    chunk_size = custom_conversions_sender.get_chunk_size()
-    assert chunk_size == 3
+    rows = [{'ad_id': str(i), 'type': 'purchase', 'date': '2019-01-02', 'actions': i} for i in range(25)]
+    os.environ['supersecret'] = 'foo'
+    custom_conversions_sender = CustomConversionSender(rows, 'supersecret')
+    custom_conversions_sender.MAX_ROWS_PER_PAYLOAD = 10
+    result = custom_conversions_sender.send()
+    assert len(responses.calls) == 3
+    assert result == {'successes': 15, 'failures': 10}
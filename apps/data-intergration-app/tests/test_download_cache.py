@@ -0,0 +1,77 @@
+import io
+import os
+import pytest
+from app.download_cache import DownloadCache, cached_download, DOWNLOAD_CACHE_DIR
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(DOWNLOAD_CACHE_DIR, str(tmp_path))
+    return tmp_path
+
+
+class CountingSource:
+    def __init__(self, content):
+        self.content = content
+        self.downloads = 0
+
+    def download(self, writer):
+        self.downloads += 1
+        writer.write(self.content)
+
+
+def test_cached_download_reads_second_download_from_cache(cache_dir):
+    source = CountingSource(b'a,b\n1,2\n')
+    for _ in range(2):
+        target = io.BytesIO()
+        cached_download('sftp://host:22/a.csv', 'sftp:a.csv:8:1600000000', source.download, target)
+        assert target.getvalue() == b'a,b\n1,2\n'
+    assert source.downloads == 1
+
+
+def test_cached_download_of_changed_file(cache_dir):
+    source = CountingSource(b'a,b\n1,2\n')
+    cached_download('sftp://host:22/a.csv', 'sftp:a.csv:8:1600000000', source.download, io.BytesIO())
+    cached_download('sftp://host:22/a.csv', 'sftp:a.csv:8:1600000001', source.download, io.BytesIO())
+    assert source.downloads == 2
+    # Same content, stored once
+    assert len(os.listdir(cache_dir / 'blobs')) == 1
+
+
+def test_cached_download_without_cache_dir(monkeypatch):
+    monkeypatch.delenv(DOWNLOAD_CACHE_DIR, raising=False)
+    source = CountingSource(b'a,b\n1,2\n')
+    for _ in range(2):
+        cached_download('sftp://host:22/a.csv', 'fingerprint', source.download, io.BytesIO())
+    assert source.downloads == 2
+
+
+def test_failed_download_is_not_cached(cache_dir):
+    def download(writer):
+        writer.write(b'a,b\n')
+        raise ConnectionResetError('Connection dropped')
+
+    with pytest.raises(ConnectionResetError):
+        cached_download('sftp://host:22/a.csv', 'fingerprint', download, io.BytesIO())
+    assert os.listdir(cache_dir / 'blobs') == []
+
+
+def test_least_recently_used_blobs_are_evicted(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_size=25)
+    for name in ['a', 'b', 'c']:
+        cache.write(name, 'fingerprint', lambda writer, name=name: writer.write(name.encode() * 10), io.BytesIO())
+        # Reading a marks it as recently used
+        assert cache.read('a', 'fingerprint', io.BytesIO())
+
+    assert cache.read('a', 'fingerprint', io.BytesIO())
+    assert not cache.read('b', 'fingerprint', io.BytesIO())
+    assert cache.read('c', 'fingerprint', io.BytesIO())
+
+
+def test_keys_of_evicted_blobs_are_removed(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_size=15)
+    for name in ['a', 'b']:
+        cache.write(name, 'fingerprint', lambda writer, name=name: writer.write(name.encode() * 10), io.BytesIO())
+
+    assert len(os.listdir(tmp_path / 'blobs')) == 1
+    assert len(os.listdir(tmp_path / 'keys')) == 1
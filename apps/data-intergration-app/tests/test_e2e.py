@@ -4,7 +4,6 @@ import os
 from datetime import datetime, timedelta
 from app.models import ProcessingConfig, ProcessingEntry
 from app.sync import SyncProcessor
-from io import BytesIO
 from tests.boto3_mocks import BotoResourceMock
 
 
@@ -193,7 +192,9 @@ def test_trigger_sync_with_s3_file(db, client, app, mocker, example_s3_file_byte
 
     mocker.patch('boto3.resource', BotoResourceMock)
     mocker.patch(
-        'app.s3.download_file_from_s3', return_value=BytesIO(example_s3_file_bytes)
+        'app.s3.download_file_from_s3',
+        side_effect=lambda bucket, item_key, file_object, transfer_config=None: file_object.write(
+            example_s3_file_bytes)
     )
 
     db.session.add(config)
@@ -299,3 +300,15 @@ def test_trigger_sync_multiplatform_s2s_with_token_in_config(db, client, app):
         assert entry.output_rows_generated == 4
         assert entry.output_rows_accepted == 4
     assert len(responses.calls) == 8
+
+
+def test_failed_sync_raises_the_sync_error_when_scheduling_fails(db, client, app, mocker, config):
+    db.session.add(config)
+    db.session.commit()
+
+    sync_processor = SyncProcessor(config)
+    mocker.patch.object(sync_processor, 'get_readers', side_effect=ConnectionResetError('Connection dropped'))
+    mocker.patch('app.sync.schedule_next_polls', side_effect=Exception('Database unavailable'))
+
+    with pytest.raises(ConnectionResetError):
+        sync_processor.run_sync()
@@ -0,0 +1,266 @@
+import io
+import os
+import stat
+from datetime import datetime
+from ftplib import error_perm
+from types import SimpleNamespace
+from app.ftp import list_sftp_files, ThreadLocalPool, list_ftp_files, parse_list_line, FTPFile, download_ftp_file
+from app.ftp import ftp_connection_alive, new_ftp_files
+from app.resumable import DOWNLOAD_SPOOL_DIR
+
+
+def sftp_attr(filename, is_dir=False, is_link=False):
+    mode = stat.S_IFDIR | 0o755 if is_dir else stat.S_IFREG | 0o644
+    if is_link:
+        mode = stat.S_IFLNK | 0o777
+    return SimpleNamespace(filename=filename, st_mode=mode, st_size=10, st_mtime=1600000000)
+
+
+class SFTPChannelMock:
+    """Directories are dicts, files None and links the path of their target."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.listed = []
+
+    def listdir_attr(self, directory):
+        self.listed.append(directory)
+        return [
+            sftp_attr(name, isinstance(children, dict), isinstance(children, str))
+            for name, children in self.tree[directory].items()
+        ]
+
+    def normalize(self, path):
+        directory, name = os.path.split(path)
+        target = self.tree[directory or '.'][name] if name not in ['', '.'] else None
+        return '/' + (target if isinstance(target, str) else path.lstrip('./'))
+
+    def stat(self, path):
+        directory, name = os.path.split(path)
+        target = self.tree[directory or '.'][name]
+        if isinstance(target, str):
+            target_directory, target_name = os.path.split(target)
+            if target_name not in self.tree.get(target_directory or '.', {}):
+                raise IOError(2, 'No such file')
+            target = self.tree[target_directory or '.'][target_name]
+        return sftp_attr(None, isinstance(target, dict))
+
+
+TREE = {
+    '.': {'a.csv': None, 'sub': {}, 'b.csv': None, 'other': {}},
+    'sub': {'c.csv': None, 'deeper': {}},
+    'sub/deeper': {'d.csv': None},
+    'other': {'e.csv': None},
+}
+
+
+def test_list_sftp_files_walks_subdirs_depth_first():
+    channel = SFTPChannelMock(TREE)
+    channels = ThreadLocalPool(lambda: channel, lambda channel: None)
+    files = [file_path for file_path, _ in list_sftp_files(channels, check_subdir=True)]
+    assert files == ['a.csv', 'b.csv', 'sub/c.csv', 'sub/deeper/d.csv', 'other/e.csv']
+    assert channel.listed == ['.', 'sub', 'other', 'sub/deeper']
+
+
+def test_list_sftp_files_skips_subdirs():
+    channel = SFTPChannelMock(TREE)
+    channels = ThreadLocalPool(lambda: channel, lambda channel: None)
+    files = [file_path for file_path, _ in list_sftp_files(channels)]
+    assert files == ['a.csv', 'b.csv']
+    assert channel.listed == ['.']
+
+
+def test_list_sftp_files_in_parallel():
+    channel = SFTPChannelMock(TREE)
+    channels = ThreadLocalPool(lambda: channel, lambda channel: None)
+    files = [file_path for file_path, _ in list_sftp_files(channels, check_subdir=True, max_workers=3)]
+    assert files == ['a.csv', 'b.csv', 'sub/c.csv', 'sub/deeper/d.csv', 'other/e.csv']
+
+
+def test_list_sftp_files_follows_links():
+    tree = {
+        '.': {'a.csv': None, 'linked': 'sub', 'linked.csv': 'sub/c.csv', 'broken.csv': 'gone.csv', 'sub': {}},
+        'sub': {'c.csv': None, 'loop': 'sub'},
+        'linked': {'c.csv': None, 'loop': 'sub'},
+    }
+    channel = SFTPChannelMock(tree)
+    channels = ThreadLocalPool(lambda: channel, lambda channel: None)
+    files = [file_path for file_path, _ in list_sftp_files(channels, check_subdir=True)]
+    # The link back to sub is only walked once
+    assert files == ['a.csv', 'linked.csv', 'linked/c.csv', 'sub/c.csv']
+    assert channel.listed == ['.', 'linked', 'sub']
+
+
+class FTPConnectionMock:
+    def __init__(self, mlsd=None, list_lines=None):
+        self.mlsd_entries = mlsd
+        self.list_lines = list_lines
+        self.commands = []
+
+    def mlsd(self):
+        self.commands.append('MLSD')
+        if self.mlsd_entries is None:
+            raise error_perm('500 Unknown command')
+        return iter(self.mlsd_entries)
+
+    def retrlines(self, command, callback):
+        self.commands.append(command)
+        for line in self.list_lines:
+            callback(line)
+
+    def nlst(self):
+        self.commands.append('NLST')
+        return ['a.csv']
+
+    def voidcmd(self, command):
+        self.commands.append(command)
+        return '213 20200131101500'
+
+
+def test_list_ftp_files_with_mlsd():
+    connection = FTPConnectionMock(mlsd=[
+        ('.', {'type': 'cdir', 'modify': '20200131101500'}),
+        ('sub', {'type': 'dir', 'modify': '20200131101500'}),
+        ('a.csv', {'type': 'file', 'size': '1234', 'modify': '20200131101500.123'}),
+    ])
+    assert list_ftp_files(connection) == [FTPFile('a.csv', 1234, 1580465700)]
+    assert connection.commands == ['MLSD']
+
+
+def test_list_ftp_files_falls_back_to_list():
+    connection = FTPConnectionMock(list_lines=[
+        'total 8',
+        'drwxr-xr-x   2 owner group   4096 Jan 31  2020 sub',
+        '-rw-r--r--   1 owner group   1234 Jan 31  2020 old file.csv',
+        '01-31-20  10:15AM       1234 dos.csv',
+        '01-31-20  10:15AM  <DIR>  dos_dir',
+    ])
+    assert list_ftp_files(connection) == [
+        FTPFile('old file.csv', 1234, 1580515199, True),
+        FTPFile('dos.csv', 1234, 1580465759, True),
+    ]
+    assert connection.commands == ['MLSD', 'LIST']
+
+
+def test_new_ftp_files_confirms_list_times_close_to_last_sync_with_mdtm():
+    connection = FTPConnectionMock(list_lines=[
+        '01-31-20  01:15PM       1234 near.csv',
+        '02-05-20  10:15AM       1234 later.csv',
+        '01-20-20  10:15AM       1234 earlier.csv',
+    ])
+    # LIST times are in the time zone of the server, MDTM puts near.csv before the last sync
+    files = new_ftp_files(connection, None, datetime(2020, 1, 31, 12))
+    assert [file.name for file, _ in files] == ['later.csv']
+    assert connection.commands == ['MLSD', 'LIST', 'MDTM near.csv']
+
+
+def test_parse_list_line_without_year():
+    now = datetime(2021, 1, 10)
+    assert parse_list_line('-rw-r--r-- 1 owner group 12 Jan 05 10:15 new.csv', now).timestamp == 1609841759
+    # In the future for this year, so from last year
+    assert parse_list_line('-rw-r--r-- 1 owner group 12 Dec 30 10:15 dec.csv', now).timestamp == 1609323359
+
+
+def test_list_ftp_files_falls_back_to_nlst_for_unknown_list_format():
+    connection = FTPConnectionMock(list_lines=['something unexpected'])
+    files = list_ftp_files(connection)
+    assert [file.name for file in files] == ['a.csv']
+    assert connection.commands == ['MLSD', 'LIST', 'NLST', 'MDTM a.csv']
+
+
+CONTENT = b'a,b\n' + b'1,2\n' * 100
+
+
+class FTPTransferMock:
+    """Control connection sending CONTENT from the REST offset on, the first transfer drops after 10 bytes."""
+
+    def __init__(self, drop):
+        self.drop = drop
+        self.offsets = []
+        self.closed = False
+
+    def retrbinary(self, command, callback, blocksize=None, rest=None):
+        self.offsets.append(rest)
+        data = CONTENT[rest or 0:]
+        if self.drop:
+            callback(data[:10])
+            raise ConnectionResetError('Connection dropped')
+        callback(data)
+
+
+def test_download_ftp_file_resumes_over_new_connection(tmp_path, monkeypatch):
+    monkeypatch.setenv(DOWNLOAD_SPOOL_DIR, str(tmp_path))
+    monkeypatch.setattr('app.resumable.time.sleep', lambda seconds: None)
+    opened = []
+
+    def open_connection():
+        opened.append(FTPTransferMock(drop=not opened))
+        return opened[-1]
+
+    def close_connection(connection):
+        connection.closed = True
+
+    connections = ThreadLocalPool(open_connection, close_connection)
+    writer = io.BytesIO()
+    download_ftp_file(connections, 'a.csv', writer, 'ftp://host:21/a.csv', 'fingerprint', len(CONTENT))
+
+    assert writer.getvalue() == CONTENT
+    assert [connection.offsets for connection in opened] == [[None], [10]]
+    assert opened[0].closed
+    assert connections.connections == [opened[1]]
+
+
+class IdleFTPConnectionMock(FTPTransferMock):
+    """Control connection the server dropped while it was idle."""
+
+    def __init__(self, dropped):
+        super().__init__(drop=False)
+        self.dropped = dropped
+
+    def voidcmd(self, command):
+        if self.dropped:
+            raise EOFError()
+        return '200 NOOP ok'
+
+
+def test_pool_replaces_connection_dropped_while_idle():
+    opened = []
+
+    def open_connection():
+        opened.append(IdleFTPConnectionMock(dropped=False))
+        return opened[-1]
+
+    def close_connection(connection):
+        connection.closed = True
+
+    connections = ThreadLocalPool(open_connection, close_connection, ftp_connection_alive)
+    writer = io.BytesIO()
+    download_ftp_file(connections, 'a.csv', writer)
+    assert connections.get() is opened[0]
+
+    opened[0].dropped = True
+    writer = io.BytesIO()
+    download_ftp_file(connections, 'b.csv', writer)
+
+    assert writer.getvalue() == CONTENT
+    assert len(opened) == 2
+    assert opened[0].closed
+    assert connections.connections == [opened[1]]
+
+
+def test_pool_opens_new_connections_after_close():
+    opened = []
+
+    def open_connection():
+        opened.append(SimpleNamespace(closed=False))
+        return opened[-1]
+
+    def close_connection(connection):
+        connection.closed = True
+
+    connections = ThreadLocalPool(open_connection, close_connection)
+    first = connections.get()
+    connections.close()
+    assert first.closed
+    assert connections.get() is opened[1]
+    assert connections.connections == [opened[1]]
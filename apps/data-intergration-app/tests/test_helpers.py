@@ -1,4 +1,11 @@
-from app.helpers import get_csv_reader
+import codecs
+import hashlib
+import time
+from io import BytesIO
+from flask import current_app
+from app import helpers
+from app.helpers import get_csv_reader, iter_decoded_lines, HashingSpool, get_reader_from_spool, ordered_map
+from app.helpers import detect_encoding
 
 
 def test_get_csv_reader_comma_separated():
@@ -13,3 +20,83 @@ def test_get_csv_reader_tab_separated():
     reader = get_csv_reader(csv_data)
     for row in reader:
         assert row['foo'] == 'foo'
+
+
+def test_iter_decoded_lines_matches_splitlines_across_chunks():
+    data = 'foo,bär\r\nbaz,qux\rlast,ä\nend'.encode('utf-8')
+    lines = list(iter_decoded_lines(BytesIO(data), 'utf-8', chunk_size=3))
+    assert lines == data.decode('utf-8').splitlines()
+
+
+def test_hashing_spool_reader():
+    data = b'foo,bar,baz\nfoo,test,test\n'
+    spool = HashingSpool()
+    for i in range(0, len(data), 4):
+        spool.write(data[i:i + 4])
+    fetched_file = get_reader_from_spool(spool, 'test.csv')
+    assert fetched_file.md5 == hashlib.md5(data).hexdigest()
+    assert fetched_file.filename == 'test.csv'
+    assert fetched_file.size == len(data)
+    assert [row['bar'] for row in fetched_file.reader] == ['test']
+
+
+def test_hashing_spool_empty_file():
+    assert get_reader_from_spool(HashingSpool(), 'empty.csv') is None
+
+
+def test_ordered_map_keeps_input_order():
+    def slow_square(value):
+        time.sleep(0.01 * (5 - value))
+        return value * value
+
+    assert list(ordered_map(slow_square, range(5), max_workers=3)) == [0, 1, 4, 9, 16]
+    assert list(ordered_map(slow_square, range(5))) == [0, 1, 4, 9, 16]
+
+
+def test_ordered_map_runs_in_app_context(app):
+    assert list(ordered_map(lambda _: current_app.name, range(2), max_workers=2)) == [app.name, app.name]
+
+
+def test_detect_encoding_bom_fast_path():
+    assert detect_encoding(codecs.BOM_UTF8 + b'foo,bar') == 'UTF-8-SIG'
+    assert detect_encoding(codecs.BOM_UTF16_LE + 'foo'.encode('utf-16-le')) == 'UTF-16'
+
+
+def test_detect_encoding_uses_hint_when_sample_fits():
+    assert detect_encoding(b'foo,bar', 'windows-1252') == 'windows-1252'
+    assert detect_encoding('foo,bär'.encode('utf-8'), 'UTF-8') == 'UTF-8'
+    # Valid UTF-8 is not trusted to a single byte hint
+    assert detect_encoding('foo,bär,ääkköset'.encode('utf-8'), 'windows-1252') != 'windows-1252'
+
+
+def test_hashing_spool_falls_back_to_whole_file_detection(monkeypatch):
+    monkeypatch.setattr(helpers, 'ENCODING_SAMPLE_SIZE', 16)
+    data = b'foo,bar,baz\nfoo,test,test\n' + 'foo,bär,äö\n'.encode('latin-1') * 50
+    spool = HashingSpool('UTF-8')
+    for i in range(0, len(data), 8):
+        spool.write(data[i:i + 8])
+    fetched_file = get_reader_from_spool(spool, 'test.csv')
+    assert fetched_file.encoding.upper() != 'UTF-8'
+    assert [row['bar'] for row in fetched_file.reader][-1] == 'bär'
+
+
+def test_hashing_spool_switches_from_single_byte_hint_to_utf8(monkeypatch):
+    monkeypatch.setattr(helpers, 'ENCODING_SAMPLE_SIZE', 16)
+    data = b'name,city\nfoo,bar\n' + 'Jörg,Zürich\n'.encode('utf-8') * 50
+    spool = HashingSpool('windows-1252')
+    for i in range(0, len(data), 8):
+        spool.write(data[i:i + 8])
+    fetched_file = get_reader_from_spool(spool, 'test.csv')
+    assert fetched_file.encoding == 'UTF-8'
+    assert list(fetched_file.reader)[-1] == {'name': 'Jörg', 'city': 'Zürich'}
+
+
+def test_hashing_spool_keeps_single_byte_hint_for_single_byte_data(monkeypatch):
+    monkeypatch.setattr(helpers, 'ENCODING_SAMPLE_SIZE', 16)
+    data = b'name,city\nfoo,bar\n' + 'Jörg,Zürich\n'.encode('windows-1252') * 50
+    spool = HashingSpool('windows-1252')
+    for i in range(0, len(data), 8):
+        spool.write(data[i:i + 8])
+    fetched_file = get_reader_from_spool(spool, 'test.csv')
+    assert fetched_file.encoding == 'windows-1252'
+    assert list(fetched_file.reader)[-1] == {'name': 'Jörg', 'city': 'Zürich'}
@@ -0,0 +1,39 @@
+import responses
+from app.http import get_file_from_url
+
+URL = 'https://example.com/conversions.csv'
+
+
+@responses.activate
+def test_get_file_from_url_returns_validators():
+    responses.add(
+        responses.GET, URL, body='a,b\n1,2\n', status=200,
+        headers={'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2020 07:28:00 GMT'})
+
+    fetched_file, validators = get_file_from_url(URL)
+
+    assert [dict(row) for row in fetched_file.reader] == [{'a': '1', 'b': '2'}]
+    assert validators == {'url': URL, 'etag': '"abc"', 'last_modified': 'Wed, 21 Oct 2020 07:28:00 GMT'}
+    assert 'If-None-Match' not in responses.calls[0].request.headers
+
+
+@responses.activate
+def test_get_file_from_url_not_modified():
+    responses.add(responses.GET, URL, status=304)
+    validators = {'url': URL, 'etag': '"abc"', 'last_modified': 'Wed, 21 Oct 2020 07:28:00 GMT'}
+
+    fetched_file, new_validators = get_file_from_url(URL, validators=validators)
+
+    assert fetched_file is None
+    assert new_validators == validators
+    assert responses.calls[0].request.headers['If-None-Match'] == '"abc"'
+    assert responses.calls[0].request.headers['If-Modified-Since'] == 'Wed, 21 Oct 2020 07:28:00 GMT'
+
+
+@responses.activate
+def test_get_file_from_url_ignores_validators_of_other_url():
+    responses.add(responses.GET, URL, body='a,b\n1,2\n', status=200)
+
+    get_file_from_url(URL, validators={'url': 'https://example.com/other.csv', 'etag': '"abc"'})
+
+    assert 'If-None-Match' not in responses.calls[0].request.headers
@@ -0,0 +1,11 @@
+from app.liquid_templates import get_template, render
+
+
+def test_templates_are_compiled_once():
+    source = '{{ value | times: 2 }}'
+    assert get_template(source) is get_template(source)
+    assert render(source, value=21) == '42'
+
+
+def test_fromtimestamp_filter_is_registered():
+    assert render('{{ 0 | fromtimestamp | date: "%Y" }}') in ['1969', '1970']
@@ -0,0 +1,63 @@
+import time
+from app.locks import LeaseLock, RENEW_SCRIPT
+
+
+class RedisMock:
+    """Keys without expiry, expire() drops a key as if its TTL ran out."""
+
+    def __init__(self):
+        self.values = {}
+        self.renewals = 0
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def expire(self, key):
+        self.values.pop(key, None)
+
+    def register_script(self, script):
+        def run(keys, args):
+            if self.values.get(keys[0]) != args[0]:
+                return 0
+            if script == RENEW_SCRIPT:
+                self.renewals += 1
+            else:
+                del self.values[keys[0]]
+            return 1
+        return run
+
+
+def test_lease_lock_is_exclusive_until_released(app):
+    redis = RedisMock()
+    lease = LeaseLock(redis, 'lease')
+    assert lease.acquire()
+    assert not LeaseLock(redis, 'lease').acquire()
+    lease.release()
+    other = LeaseLock(redis, 'lease')
+    assert other.acquire()
+    other.release()
+    assert redis.values == {}
+
+
+def test_lease_lock_heartbeat_renews_and_detects_loss(app):
+    redis = RedisMock()
+    lease = LeaseLock(redis, 'lease', ttl_ms=30)
+    assert lease.acquire()
+    time.sleep(0.1)
+    assert redis.renewals > 0
+    assert not lease.lost
+
+    # The lease expired (e.g. the worker stalled) and another worker took it
+    redis.expire('lease')
+    other = LeaseLock(redis, 'lease')
+    assert other.acquire()
+    time.sleep(0.1)
+    assert lease.lost
+
+    # Releasing the lost lease leaves the one of the other worker alone
+    lease.release()
+    assert redis.values['lease'] == other.token
+    other.release()
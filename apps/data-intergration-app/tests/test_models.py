@@ -1,5 +1,6 @@
+import datetime
 import pytest
-from app.models import ProcessingConfig
+from app.models import ProcessingConfig, ProcessingEntry
 from app.parsers.visualiq import VisualIqParser
 
 
@@ -46,3 +47,116 @@ def test_processing_config_check_subdirs_default(db):
     configs = ProcessingConfig.query.all()
     assert len(configs) == 1  # Make sure db has been emptied
     assert configs[0].check_subdirs is False
+
+
+def test_get_processed_md5s_and_fingerprints(db):
+    processing_config = ProcessingConfig(
+        file_url="test",
+        customer="foo",
+        import_type="custom_conversion_import",
+        parser_class="VisualIqParser"
+    )
+    db.session.add(processing_config)
+    db.session.commit()
+    for status, md5, fingerprint in [
+            ('succeeded', 'md5-1', 'sftp:a.csv:10:1'),
+            ('started', 'md5-2', None),
+            ('failed', 'md5-3', 'sftp:c.csv:10:1')]:
+        db.session.add(ProcessingEntry(
+            config_id=processing_config.id, status=status, file_url='a.csv', file_md5=md5,
+            file_fingerprint=fingerprint))
+    db.session.commit()
+
+    md5s, fingerprints = ProcessingEntry.get_processed_md5s_and_fingerprints(processing_config.id)
+    assert md5s == {'md5-1', 'md5-2'}
+    assert fingerprints == {'sftp:a.csv:10:1'}
+
+
+def test_get_processed_fingerprints_by_config_of_candidates(db):
+    configs = [
+        ProcessingConfig(file_url="test", customer=customer, import_type="custom_conversion_import",
+                         parser_class="VisualIqParser")
+        for customer in ['foo', 'bar']]
+    db.session.add_all(configs)
+    db.session.commit()
+    for config, status, fingerprint in [
+            (configs[0], 'succeeded', 'sftp:a.csv:10:1'),
+            (configs[0], 'succeeded', 'sftp:b.csv:10:1'),
+            (configs[0], 'failed', 'sftp:c.csv:10:1'),
+            (configs[1], 'started', 'sftp:a.csv:10:1')]:
+        db.session.add(ProcessingEntry(
+            config_id=config.id, status=status, file_url='a.csv', file_md5='md5', file_fingerprint=fingerprint))
+    db.session.commit()
+
+    candidates = {
+        configs[0].id: ['sftp:a.csv:10:1', 'sftp:c.csv:10:1', 'sftp:d.csv:10:1'],
+        configs[1].id: ['sftp:b.csv:10:1'],
+    }
+    assert ProcessingEntry.get_processed_fingerprints_by_config(candidates) == {
+        configs[0].id: {'sftp:a.csv:10:1'},
+        configs[1].id: set(),
+    }
+
+
+def test_get_sync_costs_include_listing_and_downloads(db):
+    processing_config = ProcessingConfig(
+        file_url="test",
+        customer="foo",
+        import_type="custom_conversion_import",
+        parser_class="VisualIqParser"
+    )
+    db.session.add(processing_config)
+    db.session.commit()
+    sync_started_at = datetime.datetime(2021, 3, 10, 12)
+    # The files of the sync were processed after 10 minutes of listing and downloading
+    for started, finished, size in [(10, 11, 100), (15, 20, 300)]:
+        db.session.add(ProcessingEntry(
+            config_id=processing_config.id, status='succeeded', file_url='a.csv', file_md5=f'md5-{started}',
+            file_size=size, output_rows_generated=size, sync_started_at=sync_started_at,
+            started_at=sync_started_at + datetime.timedelta(minutes=started),
+            finished_at=sync_started_at + datetime.timedelta(minutes=finished)))
+    db.session.commit()
+
+    [cost] = ProcessingEntry.get_sync_costs([processing_config.id], sync_started_at - datetime.timedelta(days=1))
+    assert cost.syncs == 1
+    assert float(cost.max_seconds) == 20 * 60
+    assert float(cost.avg_bytes) == 400
+    assert float(cost.avg_rows) == 400
+
+
+def test_config_version_is_bumped_on_definition_changes_only(db):
+    processing_config = ProcessingConfig(
+        file_url="test",
+        customer="foo",
+        import_type="custom_conversion_import",
+        parser_class="VisualIqParser"
+    )
+    db.session.add(processing_config)
+    db.session.commit()
+    assert processing_config.version == 1
+
+    processing_config.last_processed_at = datetime.datetime.now()
+    processing_config.last_detected_encoding = 'UTF-8'
+    db.session.commit()
+    assert processing_config.version == 1
+
+    processing_config.field_mapping = {'platform': 'Platform'}
+    db.session.commit()
+    assert processing_config.version == 2
+
+
+def test_get_syncable_configs_by_next_sync_at(db):
+    now = datetime.datetime.now()
+    for customer, next_sync_at in [('new', None), ('due', now - datetime.timedelta(minutes=1)),
+                                   ('later', now + datetime.timedelta(hours=1))]:
+        db.session.add(ProcessingConfig(
+            file_url="test",
+            customer=customer,
+            import_type="custom_conversion_import",
+            parser_class="VisualIqParser",
+            next_sync_at=next_sync_at
+        ))
+    db.session.commit()
+
+    assert {config.customer for config in ProcessingConfig.get_syncable_configs()} == {'new', 'due'}
+    assert len(ProcessingConfig.get_syncable_configs(force=True)) == 3
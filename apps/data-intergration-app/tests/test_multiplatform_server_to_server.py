@@ -4,6 +4,7 @@ from app.multiplatform_server_to_server import MultiplatformServerToServerSender
 from app.helpers import get_csv_reader
 from app.parsers.example_multiplatform_server_to_server import ExampleMultiplatformServerToServerParser
 import os
+import json
 
 
 event_with_all_fields = {
@@ -112,3 +113,41 @@ def test_to_multiplatform_s2s_event_invalid_fields():
     event_with_invalid_fields = {**event_with_all_fields, 'invalid_field': 'invalid'}
     result = s2s_sender.to_multiplatform_s2s_event(event_with_invalid_fields)
     assert result == event_with_all_fields
+
+
+@responses.activate
+def test_concurrent_sending_counts_every_event_once():
+    def request_callback(request):
+        event = json.loads(request.body)
+        status = 200 if int(event['ad_unit_id']) % 3 else 500
+        return (status, {}, '{"message": "error"}')
+
+    responses.add_callback(
+        responses.POST, '[FILL ME IN S2S ENDPOINT]',
+        callback=request_callback,
+        content_type='application/json',
+    )
+
+    events = [{**event_with_all_fields, 'ad_unit_id': str(i)} for i in range(30)]
+    s2s_sender = MultiplatformServerToServerSender(events, 'supersecret', concurrency=5)
+    result = s2s_sender.send()
+
+    assert len(responses.calls) == 30
+    assert result['successes'] == 20
+    assert result['failures'] == 10
+
+
+@responses.activate
+def test_sends_events_from_a_generator():
+    responses.add(
+        responses.POST, '[FILL ME IN S2S ENDPOINT]',
+        json={'message': 'ok'}, status=200,
+    )
+
+    events = ({**event_with_all_fields, 'ad_unit_id': str(i)} for i in range(4))
+    s2s_sender = MultiplatformServerToServerSender(events, 'supersecret')
+    result = s2s_sender.send()
+
+    assert len(responses.calls) == 4
+    assert result['successes'] == 4
+    assert result['failures'] == 0
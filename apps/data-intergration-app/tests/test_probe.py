@@ -0,0 +1,78 @@
+import requests
+import responses
+from types import SimpleNamespace
+from app import probe
+from app.probe import probe_group, http_file_changed, probe_configs, group_configs
+
+URL = 'https://example.com/conversions.csv'
+
+
+def config(id, file_url, **kwargs):
+    fields = dict(
+        connection_port=None, connection_username='user', connection_password='secret', connection_path=None,
+        http_validators=None)
+    fields.update(kwargs)
+    return SimpleNamespace(id=id, file_url=file_url, **fields)
+
+
+def test_probe_group_per_host_and_credentials():
+    assert probe_group(config(1, 'sftp://host')) == probe_group(config(2, 'sftp://host', connection_path='/b'))
+    assert probe_group(config(1, 'sftp://host')) != probe_group(config(2, 'sftp://host', connection_username='other'))
+    assert probe_group(config(1, 's3://bucket-a')) == probe_group(config(2, 's3://bucket-b'))
+    assert probe_group(config(1, URL)) == probe_group(config(2, 'https://example.com/other.csv'))
+
+
+@responses.activate
+def test_http_file_changed_with_validators(app):
+    validators = {'url': URL, 'etag': '"abc"', 'last_modified': None}
+    responses.add(responses.HEAD, URL, status=304)
+    responses.add(responses.HEAD, URL, status=200, headers={'ETag': '"abc"'})
+    responses.add(responses.HEAD, URL, status=200, headers={'ETag': '"def"'})
+
+    with requests.Session() as session:
+        assert not http_file_changed(session, config(1, URL, http_validators=validators))
+        assert responses.calls[0].request.headers['If-None-Match'] == '"abc"'
+        assert not http_file_changed(session, config(1, URL, http_validators=validators))
+        assert http_file_changed(session, config(1, URL, http_validators=validators))
+
+
+@responses.activate
+def test_http_file_changed_without_validators(app):
+    responses.add(responses.HEAD, URL, status=200, headers={'ETag': '"abc"'})
+
+    with requests.Session() as session:
+        assert http_file_changed(session, config(1, URL))
+
+
+def test_group_configs_per_host():
+    configs = [config(1, 'sftp://a'), config(2, 'sftp://b'), config(3, 'sftp://a'), config(4, 'ftp://a')]
+    assert [[config.id for config in group] for group in group_configs(configs)] == [[1, 3], [2], [4]]
+
+
+def test_probe_configs_looks_up_candidate_fingerprints(app, monkeypatch):
+    looked_up = []
+
+    def probe_sftp(configs):
+        return {1: [], 2: ['sftp:a.csv:10:1', 'sftp:b.csv:10:1'], 3: ['sftp:c.csv:10:1']}
+
+    def get_processed_fingerprints_by_config(candidates):
+        looked_up.append(candidates)
+        return {1: set(), 2: {'sftp:a.csv:10:1'}, 3: {'sftp:c.csv:10:1'}}
+
+    monkeypatch.setattr(probe, 'probe_sftp', probe_sftp)
+    monkeypatch.setattr(probe.ProcessingEntry, 'get_processed_fingerprints_by_config',
+                        get_processed_fingerprints_by_config)
+    configs = [config(1, 'sftp://a'), config(2, 'sftp://a'), config(3, 'sftp://a')]
+
+    assert probe_configs(configs) == {1: False, 2: True, 3: False}
+    assert looked_up == [probe_sftp(configs)]
+
+
+def test_configs_of_failing_probes_are_synced(app, monkeypatch):
+    def failing_probe(configs):
+        raise ConnectionError('refused')
+
+    monkeypatch.setattr(probe, 'probe_ftp', failing_probe)
+
+    # The sync records the error
+    assert probe_configs([config(1, 'ftp://c'), config(2, 'ftp://c')]) == {1: True, 2: True}
@@ -0,0 +1,153 @@
+import hashlib
+import io
+import pytest
+from app.resumable import partial_download, IncompleteDownloadException, DOWNLOAD_SPOOL_DIR
+
+CONTENT = b''.join(b'%d,row\n' % i for i in range(1000))
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(DOWNLOAD_SPOOL_DIR, str(tmp_path))
+    monkeypatch.setattr('app.resumable.time.sleep', lambda seconds: None)
+    return tmp_path
+
+
+class FlakySource:
+    """Sends the content from an offset, failing after fail_after bytes on the first failures calls."""
+
+    def __init__(self, fail_after, failures=1):
+        self.fail_after = fail_after
+        self.failures = failures
+        self.offsets = []
+
+    def fetch_from(self, offset, write):
+        self.offsets.append(offset)
+        if self.failures:
+            self.failures -= 1
+            write(CONTENT[offset:offset + self.fail_after])
+            raise ConnectionResetError('Connection dropped')
+        write(CONTENT[offset:])
+
+
+def test_partial_download_disabled_without_spool_dir(monkeypatch):
+    monkeypatch.delenv(DOWNLOAD_SPOOL_DIR)
+    assert partial_download('sftp://host:22/a.csv', 'fingerprint') is None
+
+
+def test_sequential_download_resumes_at_offset():
+    source = FlakySource(fail_after=100)
+    partial = partial_download('sftp://host:22/a.csv', 'fingerprint', len(CONTENT))
+    partial.fetch(source.fetch_from)
+    target = io.BytesIO()
+    partial.replay(target, hashlib.md5(CONTENT).hexdigest())
+    assert source.offsets == [0, 100]
+    assert target.getvalue() == CONTENT
+
+
+def test_sequential_download_resumes_in_later_attempt():
+    source = FlakySource(fail_after=100, failures=3)
+    partial = partial_download('ftp://host:21/a.csv', 'fingerprint', len(CONTENT))
+    with pytest.raises(ConnectionResetError):
+        partial.fetch(source.fetch_from)
+    partial.close()
+
+    partial = partial_download('ftp://host:21/a.csv', 'fingerprint', len(CONTENT))
+    partial.fetch(source.fetch_from)
+    target = io.BytesIO()
+    partial.replay(target)
+    assert source.offsets == [0, 100, 200, 300]
+    assert target.getvalue() == CONTENT
+
+
+def test_changed_remote_file_starts_over():
+    source = FlakySource(fail_after=100, failures=3)
+    partial = partial_download('ftp://host:21/a.csv', 'fingerprint', len(CONTENT))
+    with pytest.raises(ConnectionResetError):
+        partial.fetch(source.fetch_from)
+    partial.close()
+
+    source = FlakySource(fail_after=0, failures=0)
+    partial = partial_download('ftp://host:21/a.csv', 'new fingerprint', len(CONTENT))
+    partial.fetch(source.fetch_from)
+    assert source.offsets == [0]
+
+
+def test_ranged_parts_download_only_missing_parts():
+    fetched = []
+    failing = {128}
+
+    def fetch_range(start, end, write):
+        fetched.append(start)
+        if start in failing:
+            failing.remove(start)
+            raise ConnectionResetError('Connection dropped')
+        write(CONTENT[start:end])
+
+    partial = partial_download('s3://bucket/a.csv', 'fingerprint', len(CONTENT))
+    partial.fetch_parts(fetch_range, 1024)
+    target = io.BytesIO()
+    partial.replay(target, hashlib.md5(CONTENT).hexdigest())
+    assert target.getvalue() == CONTENT
+    assert fetched == list(range(0, len(CONTENT), 1024))
+
+
+def test_ranged_parts_resume_from_checkpoint():
+    fetched = []
+    failures = [2048] * 3
+
+    def fetch_range(start, end, write):
+        fetched.append(start)
+        if start in failures:
+            failures.remove(start)
+            raise ConnectionResetError('Connection dropped')
+        write(CONTENT[start:end])
+
+    partial = partial_download('s3://bucket/a.csv', 'fingerprint', len(CONTENT))
+    with pytest.raises(ConnectionResetError):
+        partial.fetch_parts(fetch_range, 1024)
+    partial.close()
+
+    fetched.clear()
+    partial = partial_download('s3://bucket/a.csv', 'fingerprint', len(CONTENT))
+    partial.fetch_parts(fetch_range, 1024)
+    target = io.BytesIO()
+    partial.replay(target)
+    assert fetched == list(range(2048, len(CONTENT), 1024))
+    assert target.getvalue() == CONTENT
+
+
+def test_checksum_mismatch_discards_download(spool_dir):
+    partial = partial_download('sftp://host:22/a.csv', 'fingerprint', len(CONTENT))
+    partial.fetch(lambda offset, write: write(CONTENT[offset:]))
+    with pytest.raises(IncompleteDownloadException):
+        partial.replay(io.BytesIO(), hashlib.md5(b'other').hexdigest())
+    assert [path.suffix for path in spool_dir.iterdir()] == ['.lock']
+
+
+def test_size_mismatch_discards_download(spool_dir):
+    partial = partial_download('sftp://host:22/a.csv', 'fingerprint', len(CONTENT) + 1)
+    partial.fetch(lambda offset, write: write(CONTENT[offset:]))
+    with pytest.raises(IncompleteDownloadException):
+        partial.replay(io.BytesIO())
+    assert [path.suffix for path in spool_dir.iterdir()] == ['.lock']
+
+
+def test_concurrent_downloads_of_same_source_use_separate_files(spool_dir):
+    first = partial_download('sftp://host:22/a.csv', 'fingerprint', len(CONTENT))
+    second = partial_download('sftp://host:22/a.csv', 'fingerprint', len(CONTENT))
+    assert first.part_path != second.part_path
+
+    first.fetch(lambda offset, write: write(CONTENT[offset:offset + 100]))
+    second.fetch(lambda offset, write: write(CONTENT[offset:]))
+    first.fetch(lambda offset, write: write(CONTENT[offset:]))
+    for partial in [first, second]:
+        target = io.BytesIO()
+        partial.replay(target, hashlib.md5(CONTENT).hexdigest())
+        assert target.getvalue() == CONTENT
+    second.close()
+    first.close()
+    assert [path.suffix for path in spool_dir.iterdir()] == ['.lock']
+
+    # The source is downloaded into the shared files again once they are released
+    assert partial_download('sftp://host:22/a.csv', 'fingerprint', len(CONTENT)).part_path == first.part_path
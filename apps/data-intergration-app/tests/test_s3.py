@@ -1,25 +1,75 @@
-from app.s3 import should_process_file
-from tests.boto3_mocks import BotoObject
+import io
+import pytest
+from app.s3 import should_process_file, s3_fingerprint, list_s3_objects
+from app.s3 import transfer_settings, download_object, DEFAULT_TRANSFER_SETTINGS, S3TransferConfigException
+from tests.boto3_mocks import boto_object, BotoClientMock
 from datetime import datetime, timedelta
+from pytz import UTC
 
 
 def test_validate_file():
-    boto_item = BotoObject()
-    unaware_timezone = datetime(2020, 8, 15, 8, 15, 12, 0)
-    item = should_process_file(boto_item, unaware_timezone)
-    assert bool(item) is True
+    item = boto_object()
+    modified_after = UTC.localize(datetime(2020, 8, 15, 8, 15, 12, 0))
+    assert should_process_file(item, modified_after) is True
 
 
-def test_validate_file_content_type_is_in_correct():
-    boto_item = BotoObject()
-    boto_item.set_content_type("application/x-directory")
-    unaware_timezone = datetime(2020, 8, 15, 8, 15, 12, 0)
-    item = should_process_file(boto_item, unaware_timezone)
-    assert bool(item) is False
+def test_validate_file_directory_marker():
+    item = boto_object(key='tc-rover-s3-test/', size=0)
+    modified_after = UTC.localize(datetime(2020, 8, 15, 8, 15, 12, 0))
+    assert should_process_file(item, modified_after) is False
 
 
 def test_validate_file_processing_time_in_future():
-    boto_item = BotoObject()
-    unaware_timezone = datetime.utcnow() + timedelta(days=2)
-    item = should_process_file(boto_item, unaware_timezone)
-    assert bool(item) is False
+    item = boto_object()
+    modified_after = UTC.localize(datetime.utcnow() + timedelta(days=2))
+    assert should_process_file(item, modified_after) is False
+
+
+def test_validate_file_at_checkpoint():
+    item = boto_object()
+    assert should_process_file(item, item['LastModified']) is True
+
+
+def test_validate_file_already_processed_fingerprint():
+    item = boto_object()
+    modified_after = UTC.localize(datetime(2020, 8, 15, 8, 15, 12, 0))
+    assert should_process_file(item, modified_after, {s3_fingerprint(item)}) is False
+
+
+def test_list_s3_objects_lists_sub_prefixes_in_key_order():
+    keys = ['data/b/2.csv', 'data/a/1.csv', 'data/0.csv', 'data/a/nested/3.csv', 'other/4.csv']
+    client = BotoClientMock([boto_object(key=key) for key in keys])
+    items = list_s3_objects(client, 'bucket', 'data/', max_workers=2)
+    assert [item['Key'] for item in items] == ['data/0.csv', 'data/a/1.csv', 'data/a/nested/3.csv', 'data/b/2.csv']
+
+
+def test_transfer_settings_overrides():
+    settings = transfer_settings({'max_concurrency': 32})
+    assert settings['max_concurrency'] == 32
+    assert settings['multipart_chunksize'] == DEFAULT_TRANSFER_SETTINGS['multipart_chunksize']
+    with pytest.raises(S3TransferConfigException):
+        transfer_settings({'use_threads': 1})
+    with pytest.raises(S3TransferConfigException):
+        transfer_settings({'max_concurrency': 0})
+
+
+class PartsBucketMock:
+    """Writes the parts of an object at their offsets in reverse order, like a parallel download."""
+
+    def __init__(self, content, part_size):
+        self.content = content
+        self.part_size = part_size
+
+    def download_fileobj(self, key, file_object, Config=None):
+        offsets = list(range(0, len(self.content), self.part_size))
+        for offset in reversed(offsets):
+            file_object.seek(offset)
+            file_object.write(self.content[offset:offset + self.part_size])
+
+
+def test_download_object_replays_large_objects_in_order():
+    content = b''.join(b'%d,row\n' % i for i in range(1000))
+    settings = transfer_settings({'multipart_threshold': 100})
+    writer = io.BytesIO()
+    download_object(PartsBucketMock(content, 64), 'data.csv', writer, len(content), settings)
+    assert writer.getvalue() == content
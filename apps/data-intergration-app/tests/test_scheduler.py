@@ -0,0 +1,109 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from rq import Queue
+from app import scheduler
+from app.tasks import rq
+from app.scheduler import (
+    SyncCost, size_class, job_timeout, weighted_queue_order, SMALL_QUEUE, MEDIUM_QUEUE, BACKFILL_QUEUE,
+    MIN_TIMEOUT, MAX_TIMEOUT, expected_arrival, schedule_next_poll, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL,
+    WeightedFairWorker, BACKFILL_SLOT_KEY
+)
+
+NOW = datetime(2021, 3, 10, 12)
+
+
+def cost(avg_seconds, max_seconds=None):
+    return SyncCost(10, avg_seconds, max_seconds or avg_seconds, 0, 0)
+
+
+def test_size_class():
+    assert size_class(cost(30)) == SMALL_QUEUE
+    assert size_class(cost(20 * 60)) == MEDIUM_QUEUE
+    assert size_class(cost(3 * 60 * 60)) == BACKFILL_QUEUE
+    assert size_class(None) == MEDIUM_QUEUE
+
+
+def test_job_timeout():
+    assert job_timeout(cost(30)) == MIN_TIMEOUT
+    assert job_timeout(cost(20 * 60, 30 * 60)) == 2 * 60 * 60
+    assert job_timeout(cost(10 * 60 * 60)) == MAX_TIMEOUT
+    assert job_timeout(None) == MAX_TIMEOUT
+
+
+def test_weighted_queue_order_shares_busy_queues_by_weight():
+    queues = [SMALL_QUEUE, MEDIUM_QUEUE, BACKFILL_QUEUE]
+    credits = {}
+    first = Counter(weighted_queue_order(queues, credits, set(queues))[0] for _ in range(100))
+    assert first == {SMALL_QUEUE: 60, MEDIUM_QUEUE: 30, BACKFILL_QUEUE: 10}
+
+
+def test_weighted_queue_order_skips_idle_queues():
+    queues = [SMALL_QUEUE, MEDIUM_QUEUE, BACKFILL_QUEUE]
+    credits = {}
+    first = Counter(weighted_queue_order(queues, credits, {SMALL_QUEUE, BACKFILL_QUEUE})[0] for _ in range(70))
+    assert first == {SMALL_QUEUE: 60, BACKFILL_QUEUE: 10}
+    assert weighted_queue_order(queues, credits, set()) == queues
+
+
+def test_backfill_jobs_are_limited_to_the_backfill_slots(monkeypatch):
+    monkeypatch.setattr(scheduler, 'MAX_BACKFILL_JOBS', 1)
+    queues = [Queue(name, connection=rq.connection) for name in [SMALL_QUEUE, BACKFILL_QUEUE]]
+    for queue in queues:
+        queue.empty()
+    small, backfill = queues
+    for _ in range(2):
+        backfill.enqueue('app.tasks.sync_config', 1)
+    workers = [WeightedFairWorker(queues, connection=rq.connection) for _ in range(2)]
+    try:
+        _, queue = workers[0].dequeue_job_and_maintain_ttl(1)
+        assert queue.name == BACKFILL_QUEUE
+        # The only slot is taken, the second worker leaves the backfill queue alone
+        small.enqueue('app.tasks.sync_config', 2)
+        _, queue = workers[1].dequeue_job_and_maintain_ttl(1)
+        assert queue.name == SMALL_QUEUE
+        assert backfill.count == 1
+
+        workers[0].release_backfill_slot()
+        _, queue = workers[1].dequeue_job_and_maintain_ttl(1)
+        assert queue.name == BACKFILL_QUEUE
+    finally:
+        for worker in workers:
+            worker.release_backfill_slot()
+        for queue in queues:
+            queue.empty()
+    assert not rq.connection.exists(f'{BACKFILL_SLOT_KEY}-0')
+
+
+def test_expected_arrival_from_median_interval():
+    daily = [NOW - timedelta(days=3), NOW - timedelta(days=2), NOW - timedelta(days=1),
+             NOW - timedelta(days=1, minutes=-1), NOW - timedelta(hours=21)]
+    # Files of one delivery count as one arrival, the outlier doesn't move the median
+    assert expected_arrival(daily) == NOW + timedelta(hours=3)
+    assert expected_arrival(daily[:1]) is None
+    assert expected_arrival([]) is None
+
+
+def test_schedule_next_poll_backs_off_and_snaps_back():
+    config = SimpleNamespace(poll_interval_seconds=None, next_sync_at=None)
+    intervals = []
+    for _ in range(10):
+        schedule_next_poll(config, False, [], NOW)
+        intervals.append(config.poll_interval_seconds)
+    assert intervals[:3] == [MIN_POLL_INTERVAL, 2 * MIN_POLL_INTERVAL, 4 * MIN_POLL_INTERVAL]
+    assert intervals[-1] == MAX_POLL_INTERVAL
+    assert config.next_sync_at == NOW + timedelta(seconds=MAX_POLL_INTERVAL)
+
+    schedule_next_poll(config, True, [], NOW)
+    assert config.poll_interval_seconds == MIN_POLL_INTERVAL
+    assert config.next_sync_at == NOW + timedelta(seconds=MIN_POLL_INTERVAL)
+
+
+def test_schedule_next_poll_wakes_up_at_expected_arrival():
+    config = SimpleNamespace(poll_interval_seconds=MAX_POLL_INTERVAL, next_sync_at=None)
+    arrivals = [NOW - timedelta(days=2, hours=-1), NOW - timedelta(days=1, hours=-1)]
+
+    schedule_next_poll(config, False, arrivals, NOW)
+
+    assert config.next_sync_at == NOW + timedelta(hours=1)
+    assert config.poll_interval_seconds == MIN_POLL_INTERVAL
@@ -0,0 +1,89 @@
+import pytest
+from rq.job import Job, JobStatus
+from app import tasks
+from app.models import ProcessingConfig
+from app.producer import produce_sync_tasks
+from app.scheduler import SYNC_QUEUES, SMALL_QUEUE, MIN_POLL_INTERVAL
+from app.tasks import rq, probe_and_queue_syncs, sync_job_id, load_config, queue_sync_jobs
+
+
+@pytest.fixture
+def queues(db):
+    queues = {name: rq.get_queue(name) for name in SYNC_QUEUES}
+    for queue in queues.values():
+        queue.empty()
+    yield queues
+    for queue in queues.values():
+        queue.empty()
+
+
+def add_configs(db, *file_urls):
+    configs = [
+        ProcessingConfig(
+            file_url=file_url, customer='foo', import_type='s2s', parser_class='ExampleServerToServerParser')
+        for file_url in file_urls
+    ]
+    db.session.add_all(configs)
+    db.session.commit()
+    return [config.id for config in configs]
+
+
+def test_produce_sync_tasks_queues_a_probe_per_host(db, queues):
+    config_ids = add_configs(db, 'sftp://a', 'sftp://b', 'sftp://a')
+
+    assert produce_sync_tasks() == 3
+
+    probes = queues[SMALL_QUEUE].jobs
+    assert sorted(job.args[0] for job in probes) == [[config_ids[0], config_ids[2]], [config_ids[1]]]
+    assert all(job.func_name == 'app.tasks.probe_and_queue_syncs' for job in probes)
+    # Probes still queued are not queued again
+    produce_sync_tasks()
+    assert len(queues[SMALL_QUEUE].jobs) == 2
+
+
+def test_probe_and_queue_syncs_queues_configs_with_new_files(db, queues, monkeypatch):
+    config_ids = add_configs(db, 'sftp://a', 'sftp://a')
+    monkeypatch.setattr(tasks, 'probe_configs', lambda configs: {config_ids[0]: True, config_ids[1]: False})
+
+    probe_and_queue_syncs(config_ids)
+
+    syncs = [job for queue in queues.values() for job in queue.jobs]
+    assert [job.id for job in syncs] == [sync_job_id(config_ids[0])]
+    assert ProcessingConfig.query.get(config_ids[0]).next_sync_at is None
+    assert ProcessingConfig.query.get(config_ids[1]).poll_interval_seconds == MIN_POLL_INTERVAL
+
+
+def test_load_config_of_changed_config(db):
+    config_id, = add_configs(db, 'sftp://a')
+    ProcessingConfig.query.get(config_id).customer = 'bar'
+    db.session.commit()
+    db.session.expunge_all()
+
+    # A job queued before the change gets the current definition
+    config = load_config(config_id, 1)
+    assert config.customer == 'bar'
+    assert config.version == 2
+
+
+def test_load_config_of_deleted_config(db):
+    config_id, = add_configs(db, 'sftp://a')
+    db.session.delete(ProcessingConfig.query.get(config_id))
+    db.session.commit()
+    assert load_config(config_id, 1) is None
+
+
+def test_sync_of_finished_job_is_queued_without_expiry(db, queues):
+    config_id, = add_configs(db, 'sftp://a')
+    queue_sync_jobs([ProcessingConfig.query.get(config_id)])
+    # As a worker leaves a finished job for its result_ttl
+    job = Job.fetch(sync_job_id(config_id), connection=rq.connection)
+    for queue in queues.values():
+        queue.remove(job.id)
+    job.set_status(JobStatus.FINISHED)
+    rq.connection.expire(job.key, 500)
+
+    queue_sync_jobs([ProcessingConfig.query.get(config_id)])
+
+    job = Job.fetch(sync_job_id(config_id), connection=rq.connection)
+    assert job.get_status() == JobStatus.QUEUED
+    assert rq.connection.ttl(job.key) == -1